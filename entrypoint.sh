@@ -4,6 +4,8 @@ python3 ./manage.py makemigrations
 
 python3 ./manage.py migrate
 
+WARM_UP_MODELS=1 celery worker -A songRecommender_project -Q feature_extraction -n features@%h -l info --pool solo &> celery_features.out &
+
 celery worker -A songRecommender_project -l info --pool gevent &> celery.out
 
 python3 ./manage.py runserver 0.0.0.0:8080
@@ -1,25 +1,30 @@
 from songRecommender.models import Song, List, Distance, User, Distance_to_User, Distance_to_List, Played_Song
 # from songRecommender.Logic.model_distances_calculator import save_user_distances, save_list_distances
-from songRecommender_project.tasks import recalculate_all_distances_to_user
+from songRecommender_project.tasks import schedule_recalculation
+from songRecommender.Logic.recommendation_cache import invalidate_recommendations
+from songRecommender.Logic.top_recommendations import remove_from_top_recommendations
 import re
+from django.db.models import F
 
 
 def check_if_in_played(song_id, cur_user, is_being_played):
     """checks if the song was already played by the user, if not it adds it
     and if yes and it is being played again the number of times played is updated accordingly"""
 
-    song = Song.objects.get(id=song_id)
-
-    if song.pk in Played_Song.objects.filter(user_id=cur_user.profile).values_list('song_id1_id', flat=True):
-        if is_being_played:
-            played_song = Played_Song.objects.get(user_id=cur_user.profile, song_id1=song)
-            played_song.numOfTimesPlayed += 1
-            played_song.save()
-
+    played_song = Played_Song.objects.filter(user_id=cur_user.profile, song_id1_id=song_id)
+    # a single query both checks if the song was played and counts the new play
+    if is_being_played:
+        played = played_song.update(numOfTimesPlayed=F('numOfTimesPlayed') + 1)
     else:
-        played_song = Played_Song(user_id=cur_user.profile, song_id1=song, opinion=0, numOfTimesPlayed=1)
+        played = played_song.exists()
+
+    if not played:
+        played_song = Played_Song(user_id=cur_user.profile, song_id1_id=song_id, opinion=0, numOfTimesPlayed=1)
         played_song.save()
-        recalculate_all_distances_to_user.delay(song_id, cur_user.pk)
+        # the played song is not recommended anymore
+        remove_from_top_recommendations(cur_user.pk, song_id)
+        invalidate_recommendations([cur_user.pk])
+        schedule_recalculation(song_id, cur_user.pk, 'USER')
 
     return
 
@@ -1,15 +1,19 @@
 from songRecommender.models import Song, Distance
 import numpy, youtube_dl, re, urllib.request, librosa, os, scipy.sparse, glob, sklearn.metrics
 import urllib.parse
+import subprocess
+import functools
+import scipy.fftpack
 from bs4 import BeautifulSoup
 from songRecommender_project.settings import MP3FILES_DIR
 from pydub import AudioSegment
-from songRecommender_project.settings import GRU_Mel_graph, LSTM_MFCC_graph
-from keras.models import model_from_json
+from pydub.utils import mediainfo
 from sklearn.preprocessing import MinMaxScaler
 from pydub.playback import play
 
-from songRecommender_project.settings import PCA_Tf_idf_model, W2V_model, GRU_Mel_model, PCA_Mel_model, LSTM_MFCC_model, TF_idf_model
+from songRecommender.Logic.feature_cache import file_hash, get_cached_features, cache_features
+from songRecommender.Logic.model_registry import gru_mel_model, lstm_mfcc_model, pca_mel_model, w2v_model, \
+    tf_idf_model, pca_tf_idf_model
 
 from songRecommender_project.settings import n_fft, hop_length, n_mfcc, n_mels
 
@@ -32,86 +36,146 @@ def save_all_representations(song_id):
     :param song_id: the id of the newly added song
     :return: None
     """
+    save_representations_of_songs([song_id])
 
-    song = Song.objects.get(pk=song_id)
-    download_song_from_youtube(song)
 
-    if song.audio:
-        try:
-            y, sr = get_audio_data(song)
-            print(y, sr)
+def save_representations_of_songs(song_ids):
+    """
+    collects the representations of the added songs specified by song_ids for each of the implemented methods,
+    the features of each song are extracted separately and then each model computes the representations
+    of all the songs by a single call, for the songs whose audio download fails only lyrics based
+    methods are represented
+    :param song_ids: the ids of the newly added songs
+    :return: None
+    """
 
-            ######## Saving simple audio representations ###############
+    # the representations are computed here, only the lyrics are loaded
+    songs = list(Song.objects.with_text().filter(pk__in=song_ids))
 
-            mel_spectrogram = retrieve_mel_spectrogram_representation(y, sr).reshape([1, 130560])
-            mel_spectrogram = numpy.interp(mel_spectrogram, (mel_spectrogram.min(), mel_spectrogram.max()), (0, 1))
-            print('the melspectrogram:')
-            print(mel_spectrogram)
+    audio_songs = []
+    mel_spectrograms = []
+    mfccs = []
+    for song in songs:
+        # a song whose audio cannot be downloaded or processed is represented only by its lyrics
+        try:
+            # the mp3 file of a song processed again (e.g. by a retried task) is not downloaded again
+            if song.link_on_disc and os.path.exists(song.link_on_disc.path):
+                song.audio = True
+            else:
+                download_song_from_youtube(song)
+            if song.audio:
+                mel_spectrogram, mfcc = retrieve_audio_features(song)
+                audio_songs.append(song)
+                mel_spectrograms.append(mel_spectrogram)
+                mfccs.append(mfcc)
+        except Exception as e:
+            print('audio of song', song.pk, 'not processed', e)
+            song.audio = False
 
-            mel_spectrogram = mel_spectrogram.reshape([1, 408, 320])
-            print(mel_spectrogram.shape)
-            mfcc = retrieve_mfcc_representation(y, sr)
-            mfcc = mfcc.reshape([1, 82688])
-            mfcc = numpy.interp(mfcc, (mfcc.min(), mfcc.max()), (0, 1))
-            print('the mfcc:')
-            print(mfcc)
-            mfcc = mfcc.reshape([1, 646, 128])
+    if audio_songs:
+        try:
+            save_audio_representations(audio_songs, numpy.stack(mel_spectrograms), numpy.stack(mfccs))
+        except Exception as e:
+            print(e)
+            for song in audio_songs:
+                song.audio = False
 
+    save_text_representations(songs)
 
+    for song in songs:
+        try:
+            song.save()
+        except Exception as e:
+            print('song', song.pk, 'not saved', e)
+    print(len(songs), 'songs saved')
 
-            print('got mfcc repr')
 
-            ############################# Saving more advanced audio representations #####################
+def retrieve_audio_features(song):
+    """
+    extracts the normalized audio features of the song which are the input of the audio based methods
+    :param song: the song whose mp3 file was downloaded
+    :return: the mel-spectrogram of shape [408, 320] and the mfcc of shape [646, 128]
+    """
+    # the features of an mp3 file which was already processed are read from the cache without decoding it
+    key = file_hash(song.link_on_disc.path)
+    features = get_cached_features(key)
+    if features is not None:
+        return features
 
-            with GRU_Mel_graph.as_default():
-                gru_mel_repr = GRU_Mel_model.predict(mel_spectrogram.reshape([1, 408, 320]))[0]
-                song.gru_mel_representation = gru_mel_repr.reshape([5712]).tolist()
-                print(gru_mel_repr)
+    y, sr = get_audio_data(song)
 
-            print('gru mel predicted')
+    # the spectrogram is computed once, the mel-spectrogram is derived from it
+    spectrogram = retrieve_spectrogram_representation(y, sr)
+    mel_spectrogram = retrieve_mel_spectrogram_representation(y, sr, spectrogram).reshape([1, 130560])
+    mel_spectrogram = numpy.interp(mel_spectrogram, (mel_spectrogram.min(), mel_spectrogram.max()), (0, 1))
 
-            with LSTM_MFCC_graph.as_default():
-                lstm_mfcc_repr = LSTM_MFCC_model.predict(mfcc.reshape([1, 646, 128]))[0]
-                song.lstm_mfcc_representation = lstm_mfcc_repr.reshape([5168]).tolist()
+    mfcc = retrieve_mfcc_representation(y, sr)
+    mfcc = mfcc.reshape([1, 82688])
+    mfcc = numpy.interp(mfcc, (mfcc.min(), mfcc.max()), (0, 1))
 
+    mel_spectrogram = mel_spectrogram.reshape([408, 320])
+    mfcc = mfcc.reshape([646, 128])
+    cache_features(key, mel_spectrogram, mfcc)
+    return mel_spectrogram, mfcc
 
-            pca_mel_repr = PCA_Mel_model.transform(mel_spectrogram.reshape(1, 130560))
-            print('pca mel predicted')
-            song.pca_mel_representation = pca_mel_repr.reshape([320]).tolist()
-            print('pca mel loaded')
-        except Exception as e:
-            print(e)
-            song.audio = False
 
+def save_audio_representations(songs, mel_spectrograms, mfccs):
+    """
+    computes the audio based representations of the songs, each model predicts all the songs by a single call
+    :param songs: the songs whose representations are set, they are not saved
+    :param mel_spectrograms: the mel-spectrograms of the songs of shape [len(songs), 408, 320]
+    :param mfccs: the mfccs of the songs of shape [len(songs), 646, 128]
+    :return: None
+    """
+    GRU_Mel_model, GRU_Mel_graph = gru_mel_model.get()
+    with GRU_Mel_graph.as_default():
+        gru_mel_reprs = GRU_Mel_model.predict(mel_spectrograms, batch_size=len(songs))
+    print('gru mel predicted')
 
+    LSTM_MFCC_model, LSTM_MFCC_graph = lstm_mfcc_model.get()
+    with LSTM_MFCC_graph.as_default():
+        lstm_mfcc_reprs = LSTM_MFCC_model.predict(mfccs, batch_size=len(songs))
+    print('lstm mfcc predicted')
 
+    pca_mel_reprs = pca_mel_model.get().transform(mel_spectrograms.reshape([len(songs), 130560]))
+    print('pca mel predicted')
 
+    for song, gru_mel_repr, lstm_mfcc_repr, pca_mel_repr in zip(songs, gru_mel_reprs, lstm_mfcc_reprs,
+                                                                 pca_mel_reprs):
+        song.gru_mel_representation = gru_mel_repr.reshape([5712])
+        song.lstm_mfcc_representation = lstm_mfcc_repr.reshape([5168])
+        song.pca_mel_representation = pca_mel_repr.reshape([320])
 
-    ##################################### saving text representations ########################
 
-    try:
-        tf_idf_repr = retrieve_tf_idf_representation(song)
-        print(tf_idf_repr.shape)
-        pca_tf_idf_repr = PCA_Tf_idf_model.transform(tf_idf_repr.reshape(1,-1))
-        song.pca_tf_idf_representation = pca_tf_idf_repr.reshape([4457]).tolist()
+def save_text_representations(songs):
+    """
+    computes the lyrics based representations of the songs, the PCA of the Tf-idf vectors
+    of all the songs is computed by a single call
+    :param songs: the songs whose representations are set, they are not saved
+    :return: None
+    """
+    tf_idf_songs = []
+    tf_idf_reprs = []
+    for song in songs:
+        try:
+            tf_idf_reprs.append(retrieve_tf_idf_representation(song))
+            tf_idf_songs.append(song)
+
+            w2v_repr = retrieve_w2v_representation(song)
+            if w2v_repr.size != 300:
+                song.w2v_representation = numpy.zeros([300])
+            else:
+                song.w2v_representation = w2v_repr.reshape([300])
+        except:
+            song.lyrics = False
+    print('w2v predicted')
+
+    if tf_idf_songs:
+        pca_tf_idf_reprs = pca_tf_idf_model.get().transform(numpy.stack(tf_idf_reprs))
+        for song, pca_tf_idf_repr in zip(tf_idf_songs, pca_tf_idf_reprs):
+            song.pca_tf_idf_representation = pca_tf_idf_repr.reshape([4457])
         print('pca tf_idf_represented')
 
-        w2v_repr = retrieve_w2v_representation(song)
-        print('w2v predicted')
-        if w2v_repr.size != 300:
-            song.w2v_representation = numpy.zeros([300]).tolist()
-        else:
-            song.w2v_representation = w2v_repr.reshape([300]).tolist()
-        print('w2v representation')
-    except:
-        song.lyrics = False
-
-    song.save()
-    print('song_saved')
-
-    ######################################################################################
-    ######################################################################################
-
 
 def retrieve_tf_idf_representation(song):
     """
@@ -121,7 +185,7 @@ def retrieve_tf_idf_representation(song):
     """
     lyrics = song.text.lower()
     vector = [w.strip('.,!:?-') for w in lyrics.split(" ")]
-    tf_idf_repr = TF_idf_model.transform(vector)
+    tf_idf_repr = tf_idf_model.get().transform(vector)
     return tf_idf_repr.toarray()[0]
 
 
@@ -134,6 +198,7 @@ def retrieve_w2v_representation(song):
     lyrics = song.text.lower()
     words = [w.strip('.,!:?-') for w in lyrics.split(" ")]
     word_vecs = []
+    W2V_model = w2v_model.get()
     for word in words:
         try:
             vec = W2V_model[word]
@@ -148,22 +213,46 @@ def retrieve_w2v_representation(song):
     return vector
 
 
+def decode_audio_window(path, start, duration, sample_rate):
+    """
+    decodes a window of a mp3 file into memory with ffmpeg, only the window is decoded
+    :param path: the path to the mp3 file
+    :param start: the start of the window in seconds
+    :param duration: the length of the window in seconds
+    :param sample_rate: the sampling rate of the mp3 file
+    :return: the mono waveform of the window as exactly duration * sample_rate float32 samples
+    """
+    command = [AudioSegment.converter, '-v', 'error', '-ss', str(start), '-t', str(duration), '-i', path,
+               '-f', 'f32le', '-acodec', 'pcm_f32le', '-ac', '1', '-ar', str(sample_rate), '-']
+    output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True).stdout
+    # seeking in a mp3 file is not sample exact, the features have a fixed shape, so the window is trimmed
+    # or padded with silence to its exact length
+    length = int(round(duration * sample_rate))
+    samples = numpy.frombuffer(output, dtype='<f4')[:length]
+    if samples.shape[0] < length:
+        samples = numpy.pad(samples, (0, length - samples.shape[0]), 'constant')
+    return samples
+
+
 def get_audio_data(song):
     """
-    gets a mp3 audio file and converts it into the 15 second audio excerpt
+    gets a mp3 audio file and converts it into the 15 second audio excerpt made of 5 seconds from the beginning,
+    the middle and the end of the song. Only the three windows are decoded, straight into memory,
+    and they are resampled to the sampling rate librosa.load used
     :param song: the song of which the 15 second audio is created
     :return: returns the waveform information about the 15 second audio.
     """
-    sound = AudioSegment.from_mp3(song.link_on_disc)
-
-    sound = sound.set_channels(1)
-    beginning = sound[10000:15000]
-    middle = sound[int(len(sound)/2):(int(len(sound)/2) + 5000)]
-    end = sound[-15000:-10000]
-
-    s = beginning + middle + end
-    s.export('temp_wav_file.wav', format='wav')
-    y, sr = librosa.load('temp_wav_file.wav')
+    # link_on_disc is a FieldFile named relative to MEDIA_ROOT, ffmpeg needs the path of the file
+    path = song.link_on_disc.path
+    info = mediainfo(path)
+    length = float(info['duration'])
+    sample_rate = int(info['sample_rate'])
+
+    windows = [10, length / 2, length - 15]
+    y = numpy.concatenate([decode_audio_window(path, max(start, 0), 5, sample_rate)
+                           for start in windows])
+    sr = 22050
+    y = librosa.resample(y, sample_rate, sr)
 
     return y, sr
 
@@ -216,6 +305,25 @@ def download_song_from_youtube(song):
             print('not saved ok', e)
 
 
+# the MFCCs the LSTM model was trained on are computed with the default parameters of librosa.feature.mfcc,
+# their spectrogram has a different resolution than the mel-spectrogram, so they cannot share its STFT
+MFCC_N_FFT = 2048
+MFCC_HOP_LENGTH = 512
+MFCC_N_MELS = 128
+
+
+@functools.lru_cache(maxsize=None)
+def mel_filter_bank(sr, n_fft, n_mels):
+    """:returns the matrix of the mel filters turning a power spectrogram into a mel-spectrogram"""
+    return librosa.filters.mel(sr, n_fft, n_mels=n_mels)
+
+
+@functools.lru_cache(maxsize=None)
+def dct_matrix(n_mfcc, n_mels):
+    """:returns the matrix of the orthonormal DCT-II turning a log mel-spectrogram into the first n_mfcc mfccs"""
+    return scipy.fftpack.dct(numpy.eye(n_mels), type=2, norm='ortho', axis=0)[:n_mfcc]
+
+
 def retrieve_spectrogram_representation(y, sr):
     """
     transforms the audio time series into a spectrogram
@@ -227,14 +335,18 @@ def retrieve_spectrogram_representation(y, sr):
     return spectrogram
 
 
-def retrieve_mel_spectrogram_representation(y, sr):
+def retrieve_mel_spectrogram_representation(y, sr, spectrogram=None):
     """
     transforms the audio time series into a mel-spectrogram
     :param y: audio time series of a particular song
     :param sr: the sampling rate
+    :param spectrogram: the spectrogram of the audio time series computed by retrieve_spectrogram_representation,
+    it is computed if it is None
     :return: a mel-spectrogram from the audio time series
     """
-    mel_spectrogram = librosa.feature.melspectrogram(y=y, sr=sr, n_mels=320, n_fft=4410, hop_length=812)
+    if spectrogram is None:
+        spectrogram = retrieve_spectrogram_representation(y, sr)
+    mel_spectrogram = mel_filter_bank(sr, n_fft, n_mels).dot(spectrogram ** 2)
     return mel_spectrogram
 
 
@@ -245,5 +357,7 @@ def retrieve_mfcc_representation(y, sr):
    :param sr: the sampling rate
    :return: mfcc from the audio time series
    """
-    mfcc = librosa.feature.mfcc(y, sr, n_mfcc=n_mfcc)
+    power_spectrogram = numpy.abs(librosa.core.stft(y, n_fft=MFCC_N_FFT, hop_length=MFCC_HOP_LENGTH)) ** 2
+    mel_spectrogram = mel_filter_bank(sr, MFCC_N_FFT, MFCC_N_MELS).dot(power_spectrogram)
+    mfcc = dct_matrix(n_mfcc, MFCC_N_MELS).dot(librosa.power_to_db(mel_spectrogram))
     return mfcc
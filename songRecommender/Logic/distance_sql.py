@@ -0,0 +1,179 @@
+from django.db import connection
+from django.db.models.expressions import RawSQL
+
+from songRecommender_project.settings import SYMMETRIC_DISTANCE_STORAGE
+
+from songRecommender.models import Distance, Distance_to_User, Distance_to_List, List, Song_in_List, Played_Song, \
+    Profile
+
+"""this module contains the set-based SQL statements which maintain the similarities of songs to users and lists,
+each of them replaces a loop with a query per neighbouring song by one statement"""
+
+
+def _table(model):
+    return connection.ops.quote_name(model._meta.db_table)
+
+
+def _column(model, field):
+    return connection.ops.quote_name(model._meta.get_field(field).column)
+
+
+def _names():
+    """:returns the quoted table and column names used in the statements of this module"""
+    names = dict(
+        dtu=_table(Distance_to_User), dtu_user=_column(Distance_to_User, 'user_id'),
+        dtu_song=_column(Distance_to_User, 'song_id'), dtu_distance=_column(Distance_to_User, 'distance'),
+        dtu_type=_column(Distance_to_User, 'distance_Type'),
+        dtl=_table(Distance_to_List), dtl_list=_column(Distance_to_List, 'list_id'),
+        dtl_song=_column(Distance_to_List, 'song_id'), dtl_distance=_column(Distance_to_List, 'distance'),
+        dtl_type=_column(Distance_to_List, 'distance_Type'),
+        distance=_table(Distance), d_song_1=_column(Distance, 'song_1'), d_song_2=_column(Distance, 'song_2'),
+        d_distance=_column(Distance, 'distance'), d_type=_column(Distance, 'distance_Type'),
+        list=_table(List), list_id=_column(List, 'id'), list_user=_column(List, 'user_id'),
+        sil=_table(Song_in_List), sil_list=_column(Song_in_List, 'list_id'), sil_song=_column(Song_in_List, 'song_id'),
+        profile=_table(Profile), profile_id=_column(Profile, 'id'), profile_user=_column(Profile, 'user'),
+        profile_type=_column(Profile, 'user_selected_distance_type'), dtl_id=_column(Distance_to_List, 'id'),
+        played=_table(Played_Song), p_song=_column(Played_Song, 'song_id1'), p_user=_column(Played_Song, 'user_id'),
+        p_opinion=_column(Played_Song, 'opinion'))
+    # the similarities of the songs in both directions, with the symmetric storage each pair is stored once
+    # and the second direction is read from the same rows with the songs swapped
+    names['distances'] = names['distance']
+    if SYMMETRIC_DISTANCE_STORAGE:
+        names['distances'] = """(
+            SELECT {d_song_1}, {d_song_2}, {d_distance}, {d_type} FROM {distance}
+            UNION ALL
+            SELECT {d_song_2}, {d_song_1}, {d_distance}, {d_type} FROM {distance})""".format(**names)
+    return names
+
+
+def _execute(sql, params):
+    with connection.cursor() as cursor:
+        cursor.execute(sql.format(**_names()), params)
+        return cursor.rowcount
+
+
+def _fetch(sql, params):
+    with connection.cursor() as cursor:
+        cursor.execute(sql.format(**_names()), params)
+        return cursor.fetchall()
+
+
+def nearby_songs_of_users_lists(user_id, count):
+    """
+    :returns an expression selecting the ids of the Distance_to_List rows of the count songs most similar to each list
+    of the user specified by user_id, of the distance type the user selected and without the songs the user played,
+    so the nearby songs of all the user's lists are read by one query with an id__in lookup
+    """
+    sql = """
+        SELECT ranked.id FROM (
+            SELECT dtl.{dtl_id} AS id,
+                   row_number() OVER (PARTITION BY dtl.{dtl_list} ORDER BY dtl.{dtl_distance} DESC) AS position
+            FROM {dtl} dtl
+            JOIN {list} l ON l.{list_id} = dtl.{dtl_list}
+            JOIN {profile} p ON p.{profile_user} = l.{list_user}
+            WHERE l.{list_user} = %s
+              AND dtl.{dtl_type} = p.{profile_type}
+              AND dtl.{dtl_song} NOT IN (SELECT pl.{p_song} FROM {played} pl WHERE pl.{p_user} = p.{profile_id})
+        ) ranked
+        WHERE ranked.position <= %s"""
+    return RawSQL(sql.format(**_names()), [user_id, count])
+
+
+def upsert_distances_to_user(song_ids, user_id, distance_type):
+    """
+    adds the similarities of the songs specified by song_ids to their neighbours to the similarities of the neighbours
+    to the user specified by user_id. The similarity of each neighbour is weighted by the user's opinion of
+    the neighbour ((opinion + 1) times, once if the user did not play it). The Distance_to_User rows which do
+    not exist yet are created, the others are increased, all with one INSERT ... ON CONFLICT DO UPDATE statement.
+    A song which is in song_ids more times is added that many times.
+    :param song_ids: the ids of the songs whose neighbours' similarities to the user are updated
+    :param user_id: the id of the user (not of the profile)
+    :param distance_type: the distance type of the similarities
+    :return: a list of (song id, new similarity) tuples of the inserted or updated Distance_to_User rows
+    """
+    return [(song_id, distance) for _, song_id, distance in
+            upsert_distances_to_users(song_ids, [user_id], distance_type)]
+
+
+def upsert_distances_to_users(song_ids, user_ids, distance_type):
+    """
+    does the same as upsert_distances_to_user for all the users specified by user_ids with one statement
+    :param song_ids: the ids of the songs whose neighbours' similarities to the users are updated
+    :param user_ids: the ids of the users (not of their profiles)
+    :param distance_type: the distance type of the similarities
+    :return: a list of (user id, song id, new similarity) tuples of the inserted or updated Distance_to_User rows
+    """
+    return _fetch("""
+        INSERT INTO {dtu} ({dtu_user}, {dtu_song}, {dtu_distance}, {dtu_type})
+        SELECT profile.{profile_user}, d.{d_song_2}, SUM(d.{d_distance} * COALESCE(p.{p_opinion} + 1, 1)), d.{d_type}
+        FROM unnest(%s::integer[]) AS songs(id)
+        JOIN {distances} d ON d.{d_song_1} = songs.id
+        JOIN {profile} profile ON profile.{profile_user} = ANY(%s::integer[])
+        LEFT JOIN {played} p ON p.{p_song} = d.{d_song_2} AND p.{p_user} = profile.{profile_id}
+        WHERE d.{d_type} = %s
+        GROUP BY profile.{profile_user}, d.{d_song_2}, d.{d_type}
+        ON CONFLICT ({dtu_user}, {dtu_song}, {dtu_type})
+        DO UPDATE SET {dtu_distance} = {dtu}.{dtu_distance} + EXCLUDED.{dtu_distance}
+        RETURNING {dtu_user}, {dtu_song}, {dtu_distance}
+    """, [list(song_ids), list(user_ids), distance_type])
+
+
+def upsert_distances_to_list(song_ids, list_id, distance_type):
+    """
+    adds the similarities of the songs specified by song_ids to their neighbours to the similarities of the neighbours
+    to the list specified by list_id, weighted by the opinion of the list's owner of each neighbour
+    ((opinion + 1) times, once if the owner did not play it), with one INSERT ... ON CONFLICT DO UPDATE statement.
+    A song which is in song_ids more times is added that many times.
+    :param song_ids: the ids of the songs whose neighbours' similarities to the list are updated
+    :param list_id: the id of the list
+    :param distance_type: the distance type of the similarities
+    :return: the number of inserted or updated Distance_to_List rows
+    """
+    return _execute("""
+        INSERT INTO {dtl} ({dtl_list}, {dtl_song}, {dtl_distance}, {dtl_type})
+        SELECT l.{list_id}, d.{d_song_2}, SUM(d.{d_distance} * COALESCE(p.{p_opinion} + 1, 1)), d.{d_type}
+        FROM unnest(%s::integer[]) AS songs(id)
+        JOIN {distances} d ON d.{d_song_1} = songs.id
+        JOIN {list} l ON l.{list_id} = %s
+        LEFT JOIN {profile} profile ON profile.{profile_user} = l.{list_user}
+        LEFT JOIN {played} p ON p.{p_song} = d.{d_song_2} AND p.{p_user} = profile.{profile_id}
+        WHERE d.{d_type} = %s
+        GROUP BY l.{list_id}, d.{d_song_2}, d.{d_type}
+        ON CONFLICT ({dtl_list}, {dtl_song}, {dtl_type})
+        DO UPDATE SET {dtl_distance} = {dtl}.{dtl_distance} + EXCLUDED.{dtl_distance}
+    """, [list(song_ids), list_id, distance_type])
+
+
+def upsert_added_song_distances_to_lists(song_id, user_id, distance_type):
+    """
+    sets the similarity of the song specified by song_id to each list of the user specified by user_id to the sum of
+    its similarities to the songs in the list, for all the lists of the user with one INSERT ... ON CONFLICT
+    DO UPDATE statement. Lists without any song similar to the song get no Distance_to_List row.
+    :param song_id: the id of the added song
+    :param user_id: the id of the user whose lists are updated
+    :param distance_type: the distance type of the similarities
+    :return: the number of inserted or updated Distance_to_List rows
+    """
+    return upsert_added_song_distances_to_users_lists(song_id, [user_id], distance_type)
+
+
+def upsert_added_song_distances_to_users_lists(song_id, user_ids, distance_type):
+    """
+    does the same as upsert_added_song_distances_to_lists for the lists of all the users specified by user_ids
+    with one statement
+    :param song_id: the id of the added song
+    :param user_ids: the ids of the users whose lists are updated
+    :param distance_type: the distance type of the similarities
+    :return: the number of inserted or updated Distance_to_List rows
+    """
+    return _execute("""
+        INSERT INTO {dtl} ({dtl_list}, {dtl_song}, {dtl_distance}, {dtl_type})
+        SELECT sil.{sil_list}, d.{d_song_1}, SUM(d.{d_distance}), d.{d_type}
+        FROM {distances} d
+        JOIN {sil} sil ON sil.{sil_song} = d.{d_song_2}
+        JOIN {list} l ON l.{list_id} = sil.{sil_list}
+        WHERE d.{d_song_1} = %s AND d.{d_type} = %s AND l.{list_user} = ANY(%s::integer[])
+        GROUP BY sil.{sil_list}, d.{d_song_1}, d.{d_type}
+        ON CONFLICT ({dtl_list}, {dtl_song}, {dtl_type})
+        DO UPDATE SET {dtl_distance} = EXCLUDED.{dtl_distance}
+    """, [song_id, distance_type, list(user_ids)])
@@ -0,0 +1,37 @@
+from django.db import transaction
+
+from songRecommender.models import Distance
+from songRecommender_project.settings import DISTANCE_BATCH_SIZE, SYMMETRIC_DISTANCE_STORAGE
+
+
+def bulk_save_distances(song_1_ids, song_2_ids, distances, distance_type, batch_size=DISTANCE_BATCH_SIZE):
+    """
+    saves the similarities between the pairs of songs (song_1_ids[i], song_2_ids[i]) in both directions
+    with batched bulk inserts, pairs that are already in the database are skipped.
+    With SYMMETRIC_DISTANCE_STORAGE each pair is saved only once, with the smaller song id as song_1
+    :param song_1_ids: the ids of the first songs of the pairs
+    :param song_2_ids: the ids of the second songs of the pairs
+    :param distances: the similarity of each pair
+    :param distance_type: the distance type of the similarities
+    :param batch_size: the number of Distance rows inserted by one statement
+    :return: the number of pairs given
+    """
+    pairs = 0
+    batch = []
+    with transaction.atomic():
+        for song_1_id, song_2_id, distance in zip(song_1_ids, song_2_ids, distances):
+            if SYMMETRIC_DISTANCE_STORAGE:
+                batch.append(Distance(song_1_id=min(song_1_id, song_2_id), song_2_id=max(song_1_id, song_2_id),
+                                      distance=distance, distance_Type=distance_type))
+            else:
+                batch.append(Distance(song_1_id=song_1_id, song_2_id=song_2_id, distance=distance,
+                                      distance_Type=distance_type))
+                batch.append(Distance(song_1_id=song_2_id, song_2_id=song_1_id, distance=distance,
+                                      distance_Type=distance_type))
+            pairs = pairs + 1
+            if len(batch) >= batch_size:
+                Distance.objects.bulk_create(batch, ignore_conflicts=True)
+                batch = []
+        if batch:
+            Distance.objects.bulk_create(batch, ignore_conflicts=True)
+    return pairs
@@ -0,0 +1,250 @@
+import threading
+import numpy
+from django.db.models import Q
+
+from songRecommender.models import Song
+from songRecommender.Logic.memmap_representations import get_memmap_representations
+
+# for each distance type the Song field its representation is stored in and the length of the representation
+REPRESENTATION_FIELDS = {
+    'PCA_TF-idf': ('pca_tf_idf_representation', 4457),
+    'W2V': ('w2v_representation', 300),
+    'PCA_MEL': ('pca_mel_representation', 320),
+    'GRU_MEL': ('gru_mel_representation', 5712),
+    'LSTM_MFCC': ('lstm_mfcc_representation', 5168),
+}
+
+
+# distance types whose representations are computed from the lyrics, the songs whose lyrics could not be
+# represented (Song.lyrics is False) do not have them
+TEXT_DISTANCE_TYPES = ('PCA_TF-idf', 'W2V')
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class EmbeddingStore:
+    """
+    keeps the representations of one distance type of all songs in the database in one contiguous
+    float32 numpy matrix together with an index mapping the song ids to the rows of the matrix.
+    The store is built once from the Song table and afterwards only the songs that were added since are
+    loaded, so the similarity tasks do not have to go through the whole Song table for every added song.
+    Like the similarity tasks always did, the stores of all the distance types hold only the songs with audio,
+    the added songs without audio are still compared to them by their own representation. The memory-mapped
+    files hold all the imported songs, so with a backend the rows of the songs the store would not hold
+    are returned by excluded_rows() and skipped by the nearest neighbour index.
+
+    Attributes
+    ----------
+    distance_type : str
+        the distance type whose representations are stored, one of REPRESENTATION_FIELDS
+    matrix : numpy array
+        matrix of shape (number of songs, representation length), row i belongs to the song ids[i]
+    ids : numpy array
+        the ids of the songs in the order of the rows of the matrix
+    backend : MemmapRepresentations
+        if the memory-mapped representation files of the distance type exist, the store reads the
+        representations from them instead of keeping its own copy and appends the new songs to them
+    """
+
+    def __init__(self, distance_type, backend=None):
+        self.distance_type = distance_type
+        self.backend = backend
+        self.field, self.dimension = REPRESENTATION_FIELDS[distance_type]
+        self.matrix = numpy.empty([0, self.dimension], dtype=numpy.float32)
+        self.ids = numpy.empty([0], dtype=numpy.int64)
+        self.rows = {}
+        self._size = 0
+        self._last_id = 0
+        # rows whose representation was replaced since the nearest neighbour index last took them
+        self._replaced = set()
+        # sorted rows of the backend whose songs are not compared to the added songs
+        self._excluded_rows = numpy.empty([0], dtype=numpy.int64)
+        # songs before _last_id which did not have the representation yet when they were synced,
+        # they are dropped once the song turns out not to get it (it has no audio or its lyrics failed)
+        self._missing = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        if self.backend is not None:
+            return len(self.backend)
+        return self._size
+
+    def __contains__(self, song_id):
+        if self.backend is not None:
+            return song_id in self.backend
+        return song_id in self.rows
+
+    def sync(self, chunk_size=2000):
+        """
+        loads the representations of all songs that were added to the database since the last sync,
+        the first call loads the whole table
+        :param chunk_size: the number of rows fetched from the database at once
+        :return: None
+        """
+        sync_embedding_stores([self], chunk_size)
+
+    def add(self, song_id, representation):
+        """
+        adds or replaces the representation of a single song, used when a new song is added,
+        songs added this way are still picked up by the next sync if other songs were added in between
+        :param song_id: the id of the song
+        :param representation: the representation of the song, anything numpy can turn into an array
+        :return: None
+        """
+        with self._lock:
+            self._append(song_id, representation)
+
+    def pop_replaced_rows(self):
+        """:returns the rows whose representation was replaced since the last call, as a sorted numpy array"""
+        with self._lock:
+            rows = numpy.array(sorted(self._replaced), dtype=numpy.int64)
+            self._replaced.clear()
+        return rows
+
+    def excluded_rows(self):
+        """:returns the sorted rows of the matrix which the nearest neighbour index does not search through"""
+        return self._excluded_rows
+
+    def _exclude(self, song_ids):
+        rows = [self.backend.rows[song_id] for song_id in song_ids if song_id in self.backend.rows]
+        self._excluded_rows = numpy.array(sorted(rows), dtype=numpy.int64)
+
+    def row(self, song_id):
+        """:returns the row of the matrix the representation of the song specified by song_id is stored in"""
+        if self.backend is not None:
+            return self.backend.rows[song_id]
+        return self.rows[song_id]
+
+    def get(self, song_id):
+        """:returns the representation of the song specified by song_id as a [1, dimension] array"""
+        if self.backend is not None:
+            return self.backend.get(song_id).reshape([1, self.dimension])
+        return self.matrix[self.rows[song_id]].reshape([1, self.dimension])
+
+    def get_matrix(self):
+        """:returns the ids of the stored songs and the matrix with their representations"""
+        if self.backend is not None:
+            return self.backend.get_matrix()
+        return self.ids[:self._size], self.matrix[:self._size]
+
+    def _append(self, song_id, representation):
+        if self.backend is not None:
+            replaced = song_id in self.backend
+            self.backend.append(song_id, representation)
+            if replaced:
+                self._replaced.add(self.backend.rows[song_id])
+            return
+
+        vector = numpy.asarray(representation, dtype=numpy.float32).reshape([self.dimension])
+        if song_id in self.rows:
+            self.matrix[self.rows[song_id]] = vector
+            self._replaced.add(self.rows[song_id])
+            return
+
+        if self._size == self.matrix.shape[0]:
+            # grows the buffers geometrically so adding songs one by one stays cheap
+            capacity = max(1024, 2 * self.matrix.shape[0])
+            matrix = numpy.empty([capacity, self.dimension], dtype=numpy.float32)
+            matrix[:self._size] = self.matrix[:self._size]
+            ids = numpy.empty([capacity], dtype=numpy.int64)
+            ids[:self._size] = self.ids[:self._size]
+            self.matrix, self.ids = matrix, ids
+
+        self.matrix[self._size] = vector
+        self.ids[self._size] = song_id
+        self.rows[song_id] = self._size
+        self._size = self._size + 1
+
+
+def sync_embedding_stores(stores, chunk_size=2000):
+    """
+    loads the representations of the songs added since the last sync into all the given stores in a single pass
+    over the Song table: the ids and the representation fields of all the stores are streamed by one query
+    with a server-side cursor and each row fills the buffers of all the stores at once.
+    Songs which did not have a representation yet at a previous sync are fetched again until they get it,
+    they are deleted, or it is known they will not get it.
+    :param stores: the embedding stores to sync
+    :param chunk_size: the number of rows fetched from the database at once
+    :return: None
+    """
+    stores = sorted(stores, key=lambda store: store.distance_type)
+    for store in stores:
+        store._lock.acquire()
+    try:
+        for store in stores:
+            if store.backend is not None:
+                store.backend.refresh()
+                store._last_id = max(store._last_id, store.backend.last_id())
+
+        backed_stores = [store for store in stores if store.backend is not None]
+        if backed_stores:
+            # the backend files hold the songs regardless of their audio and lyrics,
+            # the songs the store would not take in are excluded
+            filtered = list(Song.objects.filter(Q(audio=False) | Q(lyrics=False)).values_list(
+                'id', 'audio', 'lyrics'))
+            for store in backed_stores:
+                store._exclude([song_id for song_id, audio, lyrics in filtered
+                                if not audio or (store.distance_type in TEXT_DISTANCE_TYPES and not lyrics)])
+
+        last_id = min(store._last_id for store in stores)
+        missing = set().union(*(store._missing for store in stores))
+        fields = [store.field for store in stores]
+        songs = Song.objects.filter(Q(id__gt=last_id) | Q(id__in=missing)).order_by('id')
+
+        max_id = last_id
+        found = set()
+        for row in songs.values_list('id', 'audio', 'lyrics', *fields).iterator(chunk_size):
+            song_id, audio, lyrics = row[0], row[1], row[2]
+            max_id = max(max_id, song_id)
+            found.add(song_id)
+            for store, representation in zip(stores, row[3:]):
+                if song_id <= store._last_id and song_id not in store._missing:
+                    continue
+                if not audio or (store.distance_type in TEXT_DISTANCE_TYPES and not lyrics):
+                    store._missing.discard(song_id)
+                    continue
+                if representation is None:
+                    store._missing.add(song_id)
+                    continue
+                store._append(song_id, representation)
+                store._missing.discard(song_id)
+
+        for store in stores:
+            store._last_id = max(store._last_id, max_id)
+            # the missing songs which were deleted
+            store._missing &= found
+    finally:
+        for store in stores:
+            store._lock.release()
+
+
+def get_embedding_store(distance_type, sync=True):
+    """
+    :returns the embedding store of the distance type kept in the memory of this process,
+    it is created on first use and synced with the database on every call unless sync is False
+    """
+    with _stores_lock:
+        store = _stores.get(distance_type)
+        if store is None:
+            store = EmbeddingStore(distance_type, get_memmap_representations(distance_type))
+            _stores[distance_type] = store
+    if sync:
+        store.sync()
+    return store
+
+
+def add_song_to_embedding_stores(song):
+    """
+    adds the representations of a newly saved song to all embedding stores that are already
+    loaded in this process
+    :param song: the song whose representations were just saved
+    :return: None
+    """
+    for distance_type, store in list(_stores.items()):
+        representation = getattr(song, store.field)
+        if representation is None:
+            continue
+        if not song.audio or (distance_type in TEXT_DISTANCE_TYPES and not song.lyrics):
+            continue
+        store.add(song.pk, representation)
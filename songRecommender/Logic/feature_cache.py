@@ -0,0 +1,96 @@
+import hashlib
+import os
+import tempfile
+
+import numpy
+
+from songRecommender_project.settings import FEATURE_CACHE_DIR, FEATURE_CACHE_MAX_SIZE
+
+"""this module caches the normalized mel-spectrograms and mfccs of the mp3 files on disk, so the representations
+of a song can be computed again (by a new version of a model, a retried task or a reimport) without decoding
+its audio. The features are stored in compressed .npz files named by FEATURE_VERSION and the SHA-1 hash
+of the content of the mp3 file, the modification time of a file is the time it was last used and the least
+recently used files are deleted when the cache is bigger than FEATURE_CACHE_MAX_SIZE.
+
+Only the features of the songs processed by adding_songs.retrieve_audio_features are cached, the songs
+of the imported dataset come with precomputed representations and are not in the cache until they are
+processed once"""
+
+# the version of the extracted features, it has to be increased whenever get_audio_data
+# or retrieve_audio_features change (windows, STFT parameters, normalization), so the old features are not used
+FEATURE_VERSION = 1
+
+
+def file_hash(path):
+    """:returns the key of the features of the mp3 file, made of FEATURE_VERSION and the SHA-1 hash of its content"""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(block)
+    return 'v%d_%s' % (FEATURE_VERSION, sha1.hexdigest())
+
+
+def _cache_path(key):
+    return os.path.join(FEATURE_CACHE_DIR, key + '.npz')
+
+
+def get_cached_features(key):
+    """
+    :param key: the hash of the mp3 file returned by file_hash
+    :return: the tuple of the mel-spectrogram and the mfcc of the mp3 file, None if they are not in the cache
+    """
+    path = _cache_path(key)
+    try:
+        with numpy.load(path) as features:
+            mel_spectrogram, mfcc = features['mel_spectrogram'], features['mfcc']
+        os.utime(path)
+    except (OSError, KeyError, ValueError):
+        return None
+    return mel_spectrogram, mfcc
+
+
+def cache_features(key, mel_spectrogram, mfcc):
+    """
+    saves the features of the mp3 file into the cache and deletes the least recently used features
+    if the cache is too big, the file is written under a temporary name and renamed,
+    so a concurrent reader never sees a partially written file
+    :param key: the hash of the mp3 file returned by file_hash
+    :param mel_spectrogram: the normalized mel-spectrogram of shape [408, 320]
+    :param mfcc: the normalized mfcc of shape [646, 128]
+    :return: None
+    """
+    os.makedirs(FEATURE_CACHE_DIR, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(suffix='.npz.tmp', dir=FEATURE_CACHE_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            numpy.savez_compressed(f, mel_spectrogram=mel_spectrogram.astype(numpy.float32),
+                                   mfcc=mfcc.astype(numpy.float32))
+        os.replace(temp_path, _cache_path(key))
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    evict_features(FEATURE_CACHE_MAX_SIZE)
+
+
+def evict_features(max_size):
+    """
+    deletes the least recently used features until the size of the cache is at most max_size bytes
+    :param max_size: the maximal size of the cache in bytes
+    :return: None
+    """
+    files = []
+    for entry in os.scandir(FEATURE_CACHE_DIR):
+        if entry.name.endswith('.npz'):
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+
+    size = sum(file_size for _, file_size, _ in files)
+    for _, file_size, path in sorted(files):
+        if size <= max_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # deleted by another worker
+            pass
+        size -= file_size
@@ -0,0 +1,150 @@
+import fcntl
+import os
+import threading
+import numpy
+
+from songRecommender_project.settings import MEMMAP_REPRESENTATIONS_DIR
+
+# the name of the files of each distance type, the same as the Song field the representations are stored in
+MEMMAP_FILE_NAMES = {
+    'PCA_TF-idf': 'pca_tf_idf_representation',
+    'W2V': 'w2v_representation',
+    'PCA_MEL': 'pca_mel_representation',
+    'GRU_MEL': 'gru_mel_representation',
+    'LSTM_MFCC': 'lstm_mfcc_representation',
+}
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+class MemmapRepresentations:
+    """
+    keeps the representations of one distance type in a memory-mapped .npy file so all the web and celery
+    processes share one page-cached copy and read the representations without deserializing them.
+
+    For each distance type there are two files in MEMMAP_REPRESENTATIONS_DIR:
+    <name>.npy holds a float32 matrix with a row for each song (it can have more rows than there are songs,
+    so that appending does not have to rewrite the file every time) and <name>_ids.npy holds the ids of the
+    songs in the order of the rows. Only the first len(ids) rows of the matrix are valid.
+    """
+
+    def __init__(self, distance_type, directory=MEMMAP_REPRESENTATIONS_DIR):
+        name = MEMMAP_FILE_NAMES[distance_type]
+        self.distance_type = distance_type
+        self.matrix_path = os.path.join(directory, name + '.npy')
+        self.ids_path = os.path.join(directory, name + '_ids.npy')
+        self.lock_path = os.path.join(directory, name + '.lock')
+        self.matrix = None
+        self.ids = None
+        self.rows = {}
+        self._ids_mtime = None
+
+    def exists(self):
+        return os.path.exists(self.matrix_path) and os.path.exists(self.ids_path)
+
+    def refresh(self):
+        """reopens the files if another process appended to them since they were last opened"""
+        mtime = os.stat(self.ids_path).st_mtime_ns
+        if mtime == self._ids_mtime:
+            return
+        ids = numpy.load(self.ids_path)
+        self.matrix = numpy.load(self.matrix_path, mmap_mode='r')
+        self.ids = ids
+        self.rows = {song_id: row for row, song_id in enumerate(ids.tolist())}
+        self._ids_mtime = mtime
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, song_id):
+        return song_id in self.rows
+
+    def last_id(self):
+        """:returns the highest song id that is stored, 0 if there is none"""
+        return int(self.ids.max()) if len(self.ids) else 0
+
+    def get(self, song_id):
+        """:returns the representation of the song as a read-only view into the memory-mapped file"""
+        return self.matrix[self.rows[song_id]]
+
+    def get_matrix(self):
+        """:returns the ids of the stored songs and a read-only view of the matrix with their representations"""
+        return self.ids, self.matrix[:len(self.ids)]
+
+    def append(self, song_id, representation):
+        """
+        writes the representation of a song into the files, if the song is already stored its row is rewritten.
+        Appending is guarded by a file lock, so it can be done from several processes.
+        :param song_id: the id of the song
+        :param representation: the representation of the song, anything numpy can turn into an array
+        :return: None
+        """
+        with open(self.lock_path, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.refresh()
+            vector = numpy.asarray(representation, dtype=numpy.float32).reshape([self.matrix.shape[1]])
+            row = self.rows.get(song_id, len(self.ids))
+
+            if row >= self.matrix.shape[0]:
+                self._grow()
+            matrix = numpy.load(self.matrix_path, mmap_mode='r+')
+            matrix[row] = vector
+            matrix.flush()
+            del matrix
+
+            if row == len(self.ids):
+                _save_atomically(self.ids_path, numpy.append(self.ids, numpy.int64(song_id)))
+            self.refresh()
+
+    def _grow(self):
+        """doubles the number of rows of the matrix file, the file is replaced atomically"""
+        capacity = max(1024, 2 * self.matrix.shape[0])
+        temp_path = self.matrix_path + '.tmp.npy'
+        grown = numpy.lib.format.open_memmap(temp_path, mode='w+', dtype=numpy.float32,
+                                             shape=(capacity, self.matrix.shape[1]))
+        grown[:self.matrix.shape[0]] = self.matrix
+        grown.flush()
+        del grown
+        os.replace(temp_path, self.matrix_path)
+        self.matrix = numpy.load(self.matrix_path, mmap_mode='r')
+
+    @classmethod
+    def create(cls, distance_type, ids, representations, directory=MEMMAP_REPRESENTATIONS_DIR):
+        """
+        creates (or replaces) the files of the distance type from a matrix of representations
+        :param distance_type: the distance type the representations belong to
+        :param ids: the ids of the songs in the order of the rows of representations
+        :param representations: a matrix with the representation of one song on each row
+        :return: the created MemmapRepresentations
+        """
+        os.makedirs(directory, exist_ok=True)
+        backend = cls(distance_type, directory)
+        with open(backend.lock_path, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            _save_atomically(backend.matrix_path, numpy.asarray(representations, dtype=numpy.float32))
+            _save_atomically(backend.ids_path, numpy.asarray(ids, dtype=numpy.int64))
+        backend.refresh()
+        return backend
+
+
+def _save_atomically(path, array):
+    temp_path = path + '.tmp.npy'
+    numpy.save(temp_path, array)
+    os.replace(temp_path, path)
+
+
+def get_memmap_representations(distance_type):
+    """
+    :returns the memory-mapped representations of the distance type opened in this process,
+    None if the files of the distance type were not created yet
+    """
+    with _backends_lock:
+        backend = _backends.get(distance_type)
+        if backend is None:
+            backend = MemmapRepresentations(distance_type)
+            if not backend.exists():
+                return None
+            _backends[distance_type] = backend
+    backend.refresh()
+    return backend
@@ -0,0 +1,89 @@
+import threading
+
+from songRecommender_project.settings import GRU_MEL_MODEL_JSON_PATH, GRU_MEL_MODEL_WEIGHTS_PATH, \
+    LSTM_MFCC_MODEL_PATH, PCA_MEL_MODEL_PATH, W2V_MODEL_PATH, TF_IDF_MODEL_PATH, PCA_TF_IDF_MODEL_PATH
+
+"""this module loads the models computing the representations of the added songs when they are used for the
+first time, so the web server, the management commands and the workers which never compute a representation
+do not import keras, tensorflow and gensim and do not keep the models in memory"""
+
+
+class LazyModel:
+    """
+    a model loaded by the loader the first time it is needed, the loading is thread safe,
+    so the model is loaded only once even if more threads need it at the same time
+
+    Attributes
+    ----------
+    name : str
+        the name of the model printed when it is loaded
+    loader : function
+        the function without arguments which loads and returns the model
+    """
+
+    def __init__(self, name, loader):
+        self.name = name
+        self.loader = loader
+        self._model = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """:returns the model, it is loaded if it was not loaded yet"""
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    self._model = self.loader()
+                    print(self.name, 'model loaded')
+        return self._model
+
+    def is_loaded(self):
+        return self._model is not None
+
+
+def _load_gru_mel_model():
+    import tensorflow as tf
+    from keras.models import model_from_json
+    with open(GRU_MEL_MODEL_JSON_PATH, 'r') as json_file:
+        model = model_from_json(json_file.read())
+    model.load_weights(GRU_MEL_MODEL_WEIGHTS_PATH)
+    return model, tf.get_default_graph()
+
+
+def _load_lstm_mfcc_model():
+    import tensorflow as tf
+    from keras.models import load_model
+    model = load_model(LSTM_MFCC_MODEL_PATH)
+    return model, tf.get_default_graph()
+
+
+def _load_joblib(path):
+    import joblib
+    return joblib.load(path)
+
+
+def _load_w2v_model():
+    from gensim.models.keyedvectors import KeyedVectors
+    return KeyedVectors.load(W2V_MODEL_PATH, mmap='r')
+
+
+def _load_tf_idf_model():
+    import pickle
+    with open(TF_IDF_MODEL_PATH, 'rb') as f:
+        return pickle.load(f)
+
+
+# the keras models are loaded together with the tensorflow graph they are used in
+gru_mel_model = LazyModel('gru_mel', _load_gru_mel_model)
+lstm_mfcc_model = LazyModel('lstm_mfcc', _load_lstm_mfcc_model)
+pca_mel_model = LazyModel('pca_mel', lambda: _load_joblib(PCA_MEL_MODEL_PATH))
+w2v_model = LazyModel('w2v', _load_w2v_model)
+tf_idf_model = LazyModel('tf_idf', _load_tf_idf_model)
+pca_tf_idf_model = LazyModel('pca_tf_idf', lambda: _load_joblib(PCA_TF_IDF_MODEL_PATH))
+
+MODELS = [gru_mel_model, lstm_mfcc_model, pca_mel_model, w2v_model, tf_idf_model, pca_tf_idf_model]
+
+
+def warm_up_models(**kwargs):
+    """loads all the models, called when a feature extraction worker starts, so its first song is not slowed down"""
+    for model in MODELS:
+        model.get()
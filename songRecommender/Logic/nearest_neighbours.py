@@ -0,0 +1,226 @@
+import threading
+import numpy
+
+from songRecommender.Logic.embedding_store import get_embedding_store
+from songRecommender_project.settings import NEAREST_NEIGHBOUR_INDEX, NEAREST_NEIGHBOUR_BLOCK_SIZE, IVF_N_LISTS, \
+    IVF_N_PROBE
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+class ExactIndex:
+    """
+    exact cosine similarity nearest neighbour index over the embedding store of one distance type.
+    The similarities are computed by a matrix-vector product over blocks of the stored float32 representations,
+    divided by the precomputed norms of the rows, so the representations are never copied or normalized in place.
+
+    Attributes
+    ----------
+    store : EmbeddingStore
+        the embedding store with the representations the index searches through
+    block_size : int
+        the number of rows multiplied at once
+    """
+
+    def __init__(self, store, block_size=NEAREST_NEIGHBOUR_BLOCK_SIZE):
+        self.store = store
+        self.block_size = block_size
+        self.norms = numpy.empty([0], dtype=numpy.float32)
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """
+        computes the norms of the rows that were added to the store since the last refresh and of the rows
+        whose representation was replaced, the store may be changed directly, not only by add()
+        """
+        with self._lock:
+            ids, matrix = self.store.get_matrix()
+            replaced = self.store.pop_replaced_rows()
+            replaced = replaced[replaced < len(self.norms)]
+            if len(replaced):
+                self.norms[replaced] = _row_norms(matrix[replaced])
+                self._replace(matrix, replaced)
+            if len(ids) > len(self.norms):
+                self.norms = numpy.concatenate([self.norms, _row_norms(matrix[len(self.norms):len(ids)])])
+
+    def add(self, song_id, vector):
+        """
+        adds the representation of a song to the embedding store and to the index
+        :param song_id: the id of the song
+        :param vector: the representation of the song
+        :return: None
+        """
+        self.store.add(song_id, vector)
+        self.refresh()
+
+    def query(self, vector, k=None, threshold=None, block_size=None, exclude=None):
+        """
+        finds the songs most similar to the vector
+        :param vector: the representation whose neighbours are searched for
+        :param k: the maximal number of returned neighbours, all neighbours above the threshold if None
+        :param threshold: only songs with a similarity bigger than the threshold are returned
+        :param block_size: overrides the number of rows multiplied at once
+        :param exclude: the id of a song which is not returned, the song whose neighbours are searched for
+        :return: a list of (song id, similarity) tuples sorted from the most similar song
+        """
+        self.refresh()
+        ids, matrix = self.store.get_matrix()
+        rows = self._candidate_rows(vector)
+        excluded = self.store.excluded_rows()
+        if len(excluded):
+            # the songs of the memory-mapped files which the store does not compare to the added songs
+            if rows is None:
+                rows = numpy.arange(len(self.norms))
+            rows = rows[~numpy.isin(rows, excluded)]
+        return self._search(vector, ids, matrix, rows, k, threshold, block_size or self.block_size, exclude)
+
+    def _replace(self, matrix, rows):
+        """updates the index after the representations in the rows were replaced, the norms are already updated"""
+        pass
+
+    def _candidate_rows(self, vector):
+        """:returns the rows the query is computed on, None for all of them"""
+        return None
+
+    def _search(self, vector, ids, matrix, rows, k, threshold, block_size, exclude=None):
+        query = _normalize(numpy.asarray(vector, dtype=numpy.float32).reshape([-1]))
+        if rows is None:
+            rows = numpy.arange(len(self.norms))
+
+        found_ids = []
+        found_similarities = []
+        for start in range(0, len(rows), block_size):
+            block = rows[start:start + block_size]
+            if len(block) and block[-1] - block[0] == len(block) - 1:
+                # contiguous rows are sliced so the memory-mapped matrix is read without a copy
+                representations = matrix[block[0]:block[-1] + 1]
+            else:
+                representations = matrix[block]
+            similarities = representations.dot(query) / self.norms[block]
+            if threshold is not None:
+                above = numpy.nonzero(similarities > threshold)[0]
+                block, similarities = block[above], similarities[above]
+            found_ids.append(ids[block])
+            found_similarities.append(similarities)
+
+        if not found_ids:
+            return []
+        found_ids = numpy.concatenate(found_ids)
+        found_similarities = numpy.concatenate(found_similarities)
+        if exclude is not None:
+            # the song itself would take one of the k places
+            kept = found_ids != exclude
+            found_ids, found_similarities = found_ids[kept], found_similarities[kept]
+        if k is not None and k < len(found_ids):
+            best = numpy.argpartition(-found_similarities, k)[:k]
+            found_ids, found_similarities = found_ids[best], found_similarities[best]
+        order = numpy.argsort(-found_similarities, kind='mergesort')
+        return list(zip(found_ids[order].tolist(), found_similarities[order].tolist()))
+
+
+class IVFIndex(ExactIndex):
+    """
+    approximate nearest neighbour index, an inverted file index: the normalized representations are
+    clustered with spherical k-means into n_lists clusters and a query only computes the exact similarity
+    to the songs in the n_probe clusters whose centroids are the most similar to the query.
+    The clusters are retrained when the number of songs doubles since the last training.
+    """
+
+    def __init__(self, store, n_lists=IVF_N_LISTS, n_probe=IVF_N_PROBE, block_size=NEAREST_NEIGHBOUR_BLOCK_SIZE):
+        super(IVFIndex, self).__init__(store, block_size)
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.centroids = None
+        self.lists = []
+        self._assigned = 0
+        self._trained_on = 0
+
+    def refresh(self):
+        super(IVFIndex, self).refresh()
+        with self._lock:
+            ids, matrix = self.store.get_matrix()
+            if self.centroids is None or len(self.norms) >= 2 * self._trained_on:
+                self._train(matrix)
+            elif len(self.norms) > self._assigned:
+                self._assign(matrix, self._assigned, len(self.norms))
+
+    def _train(self, matrix, iterations=10, seed=0):
+        n_lists = min(self.n_lists, len(self.norms))
+        if n_lists == 0:
+            return
+        random = numpy.random.RandomState(seed)
+        sample = random.choice(len(self.norms), min(len(self.norms), 256 * n_lists), replace=False)
+        sample.sort()
+        points = matrix[sample] / self.norms[sample, None]
+        centroids = points[random.choice(len(points), n_lists, replace=False)]
+        for _ in range(iterations):
+            assignment = points.dot(centroids.T).argmax(axis=1)
+            for c in range(n_lists):
+                members = points[assignment == c]
+                if len(members):
+                    centroids[c] = _normalize(members.sum(axis=0))
+        self.centroids = centroids
+        self.lists = [numpy.empty([0], dtype=numpy.int64) for _ in range(n_lists)]
+        self._assigned = 0
+        self._trained_on = len(self.norms)
+        self._assign(matrix, 0, len(self.norms))
+
+    def _assign(self, matrix, start, end):
+        for block_start in range(start, end, self.block_size):
+            block_end = min(end, block_start + self.block_size)
+            assignment = matrix[block_start:block_end].dot(self.centroids.T).argmax(axis=1)
+            for c in numpy.unique(assignment):
+                rows = numpy.nonzero(assignment == c)[0] + block_start
+                self.lists[c] = numpy.concatenate([self.lists[c], rows])
+        self._assigned = end
+
+    def _replace(self, matrix, rows):
+        # the replaced rows are moved to the clusters of their new representations
+        rows = rows[rows < self._assigned]
+        if self.centroids is None or not len(rows):
+            return
+        self.lists = [rows_of_list[~numpy.isin(rows_of_list, rows)] for rows_of_list in self.lists]
+        assignment = matrix[rows].dot(self.centroids.T).argmax(axis=1)
+        for c in numpy.unique(assignment):
+            self.lists[c] = numpy.concatenate([self.lists[c], rows[assignment == c]])
+
+    def _candidate_rows(self, vector):
+        if self.centroids is None:
+            return None
+        query = numpy.asarray(vector, dtype=numpy.float32).reshape([-1])
+        probes = numpy.argsort(-self.centroids.dot(query))[:self.n_probe]
+        rows = numpy.concatenate([self.lists[c] for c in probes])
+        rows.sort()
+        return rows
+
+
+def _row_norms(matrix):
+    norms = numpy.sqrt(numpy.einsum('ij,ij->i', matrix, matrix, dtype=numpy.float32))
+    # the similarity of a zero vector to anything is 0, as in sklearn's cosine_similarity
+    norms[norms == 0] = numpy.inf
+    return norms
+
+
+def _normalize(vector):
+    norm = numpy.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def get_nearest_neighbour_index(distance_type, sync=True):
+    """
+    :returns the nearest neighbour index of the distance type kept in the memory of this process,
+    which kind of index is used is set by NEAREST_NEIGHBOUR_INDEX in settings.py ('exact' or 'ivf'),
+    the embedding store of the index is synced with the database unless sync is False
+    """
+    store = get_embedding_store(distance_type, sync)
+    with _indexes_lock:
+        index = _indexes.get(distance_type)
+        if index is None:
+            if NEAREST_NEIGHBOUR_INDEX == 'ivf':
+                index = IVFIndex(store)
+            else:
+                index = ExactIndex(store)
+            _indexes[distance_type] = index
+    index.refresh()
+    return index
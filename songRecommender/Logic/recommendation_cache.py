@@ -0,0 +1,52 @@
+from django.core.cache import cache
+
+from songRecommender.models import Song, Distance_to_User, SONG_DISPLAY_FIELDS
+from songRecommender.Logic.top_recommendations import get_top_recommendations
+from songRecommender_project.settings import RECOMMENDATION_CACHE_TIMEOUT
+
+"""this module caches the songs recommended to each user, so the views do not sort the user's Distance_to_User
+rows on every page load. For each user and distance type the cache holds the ids and the similarities of the
+TOP_RECOMMENDATIONS_SIZE most similar songs the user has not played yet, the entries are deleted by the tasks
+which change the similarities of the songs to the user and by check_if_in_played when a song is played"""
+
+DISTANCE_TYPES = ['PCA_TF-idf', 'W2V', 'PCA_MEL', 'GRU_MEL', 'LSTM_MFCC']
+
+
+def _key(user_id, distance_type):
+    return 'recommendations:%d:%s' % (user_id, distance_type)
+
+
+def get_recommended_song_ids(user_id, distance_type):
+    """
+    :returns a list of (song id, similarity) tuples of the songs most similar to the user specified by user_id
+    the user has not played yet, sorted from the most similar song, from the cache if they are there,
+    otherwise they are read from the user's User_Top_Recommendations row and stored in the cache
+    """
+    key = _key(user_id, distance_type)
+    recommendations = cache.get(key)
+    if recommendations is None:
+        recommendations = get_top_recommendations(user_id, distance_type)
+        cache.set(key, recommendations, RECOMMENDATION_CACHE_TIMEOUT)
+    return recommendations
+
+
+def get_recommendations(user_id, distance_type, count=None):
+    """
+    :returns the songs recommended to the user specified by user_id as unsaved Distance_to_User objects,
+    so they can be shown by the same templates as the rows of the Distance_to_User table,
+    only the first count recommendations if count is not None
+    """
+    recommendations = get_recommended_song_ids(user_id, distance_type)[:count]
+    songs = Song.objects.only(*SONG_DISPLAY_FIELDS).in_bulk([song_id for song_id, _ in recommendations])
+    return [Distance_to_User(user_id_id=user_id, song_id=songs[song_id], distance=distance,
+                             distance_Type=distance_type)
+            for song_id, distance in recommendations if song_id in songs]
+
+
+def invalidate_recommendations(user_ids):
+    """
+    deletes the cached recommendations of all distance types of the users specified by user_ids
+    :param user_ids: the ids of the users whose recommendations changed
+    :return: None
+    """
+    cache.delete_many([_key(user_id, distance_type) for user_id in user_ids for distance_type in DISTANCE_TYPES])
@@ -0,0 +1,49 @@
+import re
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramSimilarity
+from django.db.models import F, Q
+from django.db.models.functions import Greatest
+
+from songRecommender.models import Song, SONG_DISPLAY_FIELDS
+
+"""this module searches the songs for the search box, by the stored and indexed full text search vectors
+of the songs and by the trigram similarity of the song names and artists, which finds the songs
+even when the query has a typo"""
+
+
+def prefix_query(q):
+    """
+    :returns a full text search query matching the songs which contain all the words of q,
+    the last word also as a prefix, so the songs are found while the word is being typed, None if q has no words
+    """
+    words = re.findall(r'\w+', q)
+    if not words:
+        return None
+    terms = words[:-1] + [words[-1] + ':*']
+    return SearchQuery(' & '.join(terms), search_type='raw')
+
+
+def search_songs(q, count=10):
+    """
+    finds the songs matching the query, the songs found by the full text search are ranked first
+    (a match in the artist or the song name weighs more than a match in the lyrics) and if there are
+    less than count of them, they are followed by the songs whose name or artist is the most similar
+    to the query by trigrams
+    :param q: the text typed into the search box
+    :param count: the maximal number of returned songs
+    :return: a list of songs with only the fields shown in the search results loaded
+    """
+    songs = Song.objects.only(*SONG_DISPLAY_FIELDS)
+    query = prefix_query(q)
+    found = []
+    if query is not None:
+        found = list(songs.filter(search_vector=query).annotate(
+            rank=SearchRank(F('search_vector'), query)).order_by('-rank')[:count])
+
+    if len(found) < count:
+        similar = songs.filter(Q(song_name__trigram_similar=q) | Q(artist__trigram_similar=q)).exclude(
+            id__in=[song.pk for song in found]).annotate(
+            similarity=Greatest(TrigramSimilarity('song_name', q), TrigramSimilarity('artist', q))).order_by(
+            '-similarity')[:count - len(found)]
+        found.extend(similar)
+    return found
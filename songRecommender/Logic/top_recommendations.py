@@ -0,0 +1,100 @@
+from django.db import transaction
+
+from songRecommender.models import Distance_to_User, Played_Song, User_Top_Recommendations
+from songRecommender_project.settings import TOP_RECOMMENDATIONS_SIZE
+
+"""this module maintains the User_Top_Recommendations table, the TOP_RECOMMENDATIONS_SIZE songs most similar
+to each user for each distance type which the user has not played yet. The similarities of the songs to a user
+only grow when they are recalculated, so the new top songs are always among the old top songs and the songs
+whose similarity was just changed, and they are merged without sorting all the Distance_to_User rows of the user"""
+
+
+def _played_songs(user_id):
+    return Played_Song.objects.filter(user_id__user=user_id).values_list('song_id1_id', flat=True)
+
+
+def rebuild_top_recommendations(user_id, distance_type):
+    """
+    computes the top recommendations of the user specified by user_id for the distance type
+    from all the user's Distance_to_User rows and saves them
+    :return: a list of (song id, similarity) tuples sorted from the most similar song
+    """
+    recommendations = list(Distance_to_User.objects.filter(
+        distance_Type=distance_type, user_id=user_id).exclude(
+        song_id_id__in=_played_songs(user_id)).order_by('-distance').values_list(
+        'song_id_id', 'distance')[:TOP_RECOMMENDATIONS_SIZE])
+    User_Top_Recommendations.objects.update_or_create(
+        user_id_id=user_id, distance_Type=distance_type,
+        defaults={'song_ids': [song_id for song_id, _ in recommendations],
+                  'distances': [distance for _, distance in recommendations],
+                  'refill': False})
+    return recommendations
+
+
+def get_top_recommendations(user_id, distance_type):
+    """
+    :returns a list of (song id, similarity) tuples of the songs most similar to the user specified by user_id
+    the user has not played yet, sorted from the most similar song, they are computed and saved if the user
+    has no top recommendations of the distance type yet
+    """
+    top = User_Top_Recommendations.objects.filter(user_id_id=user_id, distance_Type=distance_type).first()
+    if top is None:
+        return rebuild_top_recommendations(user_id, distance_type)
+    return list(zip(top.song_ids, top.distances))
+
+
+def merge_top_recommendations(user_id, distance_type, changed):
+    """
+    merges the new similarities of songs to the user specified by user_id into his top recommendations,
+    the top is computed again instead if a played song was removed from it when it was full
+    :param user_id: the id of the user
+    :param distance_type: the distance type of the similarities
+    :param changed: a list of (song id, new similarity) tuples of the Distance_to_User rows that were updated
+    :return: None
+    """
+    with transaction.atomic():
+        top = User_Top_Recommendations.objects.select_for_update().filter(
+            user_id_id=user_id, distance_Type=distance_type).first()
+        if top is None or top.refill:
+            rebuild_top_recommendations(user_id, distance_type)
+            return
+
+        candidates = dict(zip(top.song_ids, top.distances))
+        candidates.update(changed)
+        played = set(_played_songs(user_id).filter(song_id1_id__in=list(candidates)))
+        candidates = [(song_id, distance) for song_id, distance in candidates.items() if song_id not in played]
+        if len(candidates) < TOP_RECOMMENDATIONS_SIZE and len(top.song_ids) == TOP_RECOMMENDATIONS_SIZE:
+            # a song of the full top was played, the song which replaces it may be any other song
+            rebuild_top_recommendations(user_id, distance_type)
+            return
+
+        candidates.sort(key=lambda candidate: candidate[1], reverse=True)
+        candidates = candidates[:TOP_RECOMMENDATIONS_SIZE]
+        top.song_ids = [song_id for song_id, _ in candidates]
+        top.distances = [distance for _, distance in candidates]
+        top.save()
+
+
+def remove_from_top_recommendations(user_id, song_id):
+    """
+    removes the song specified by song_id which the user specified by user_id just played from all his top
+    recommendations. It is called during the request, so the tops are not sorted again here, those which were
+    full are marked to be computed again by merge_top_recommendations of the recalculation the play schedules
+    :return: None
+    """
+    tops = User_Top_Recommendations.objects.filter(user_id_id=user_id, song_ids__contains=[song_id])
+    for top in tops:
+        top.refill = top.refill or len(top.song_ids) == TOP_RECOMMENDATIONS_SIZE
+        position = top.song_ids.index(song_id)
+        del top.song_ids[position]
+        del top.distances[position]
+        top.save()
+
+
+def delete_top_recommendations(user_ids):
+    """
+    deletes the top recommendations of the users specified by user_ids, they are computed
+    again when they are read next time
+    :return: None
+    """
+    User_Top_Recommendations.objects.filter(user_id_id__in=user_ids).delete()
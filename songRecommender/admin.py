@@ -3,7 +3,8 @@ from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.contrib.auth.models import User
 # Register your models here
 
-from .models import Song, List, Song_in_List, Played_Song, Distance_to_List, Distance_to_User, Distance, Profile
+from .models import Song, List, Song_in_List, Played_Song, Distance_to_List, Distance_to_User, Distance, Profile, \
+    Pending_Recalculation, User_Top_Recommendations, Pending_Feature_Extraction
 
 
 class ProfileInline(admin.StackedInline):
@@ -50,6 +51,18 @@ class Distance_to_ListAdmin(admin.ModelAdmin):
     pass
 
 
+class Pending_RecalculationAdmin(admin.ModelAdmin):
+    pass
+
+
+class User_Top_RecommendationsAdmin(admin.ModelAdmin):
+    pass
+
+
+class Pending_Feature_ExtractionAdmin(admin.ModelAdmin):
+    pass
+
+
 admin.site.register(List, ListAdmin)
 admin.site.register(Song, SongAdmin)
 admin.site.register(Song_in_List, Song_in_ListAdmin)
@@ -57,5 +70,8 @@ admin.site.register(Played_Song, Played_SongAdmin)
 admin.site.register(Distance, DistanceAdmin)
 admin.site.register(Distance_to_List, Distance_to_ListAdmin)
 admin.site.register(Distance_to_User, Distance_to_UserAdmin)
+admin.site.register(Pending_Recalculation, Pending_RecalculationAdmin)
+admin.site.register(User_Top_Recommendations, User_Top_RecommendationsAdmin)
+admin.site.register(Pending_Feature_Extraction, Pending_Feature_ExtractionAdmin)
 admin.site.unregister(User)
 admin.site.register(User, UserAdmin)
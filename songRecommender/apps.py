@@ -1,5 +1,16 @@
 from django.apps import AppConfig
+from django.db import connections
+from django.db.models.signals import pre_migrate
+
+
+def create_trigram_extension(sender, using, **kwargs):
+    """creates the pg_trgm extension the trigram indexes of the songs need before the tables are migrated"""
+    with connections[using].cursor() as cursor:
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
 
 
 class SongrecommenderConfig(AppConfig):
     name = 'songRecommender'
+
+    def ready(self):
+        pre_migrate.connect(create_trigram_extension, sender=self)
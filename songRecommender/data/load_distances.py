@@ -1,51 +1,96 @@
 # from songRecommender.data.select_song_subset import get_songs_that_have_distances
 import os
 import pandas
-from songRecommender.models import Distance, Song
+from songRecommender.models import Distance, Song, update_search_vectors
+from songRecommender.Logic.memmap_representations import MemmapRepresentations
+from songRecommender.Logic.distance_writer import bulk_save_distances
 import numpy
+from django.db import transaction
 from songRecommender_project.settings import PCA_TF_IDF_THRESHOLD, W2V_THRESHOLD, LSTM_MFCC_THRESHOLD, GRU_MEL_THRESHOLD, PCA_MEL_THRESHOLD
-def load_distances(distance_matrix, distance_type, threshold):
+
+# the distance matrix and the threshold of each distance type
+DISTANCE_MATRICES = {
+    'PCA_TF-idf': ('songRecommender_project/distances/pca_tf_idf_distances.npy', PCA_TF_IDF_THRESHOLD),
+    'W2V': ('songRecommender_project/distances/w2v_distances.npy', W2V_THRESHOLD),
+    'PCA_MEL': ('songRecommender_project/distances/pca_melspectrogram_distances.npy', PCA_MEL_THRESHOLD),
+    'LSTM_MFCC': ('songRecommender_project/distances/lstm_mfcc_distances.npy', LSTM_MFCC_THRESHOLD),
+    'GRU_MEL': ('songRecommender_project/distances/gru_mel_distances_5712.npy', GRU_MEL_THRESHOLD),
+}
+
+# the representation matrix of each distance type and the Song field the representations are saved into
+REPRESENTATION_MATRICES = {
+    'PCA_TF-idf': ('songRecommender_project/representations/pca_tf_idf_representations.npy', 'pca_tf_idf_representation'),
+    'W2V': ('songRecommender_project/representations/w2v_representations.npy', 'w2v_representation'),
+    'PCA_MEL': ('songRecommender_project/representations/pca_mel_representations.npy', 'pca_mel_representation'),
+    'GRU_MEL': ('songRecommender_project/representations/GRU_mel_representations_5712.npy', 'gru_mel_representation'),
+    'LSTM_MFCC': ('songRecommender_project/representations/lstm_mfcc_representations.npy', 'lstm_mfcc_representation'),
+}
+
+
+def get_useful_song_ids():
+    """
+    resolves the ids of the songs in "useful songs" with a single query
+    :return: a numpy array where on position i is the id of the song on the ith line of "useful songs",
+    -1 if the song is not in the database
+    """
+    df = pandas.read_csv("songRecommender_project/useful_songs", sep=';',
+                         names=['songTitle','artist'], index_col=False, header=None,
+                         engine='python', error_bad_lines=False)
+    song_ids = {(song_name, artist): song_id for song_id, song_name, artist in
+                Song.objects.values_list('id', 'song_name', 'artist').iterator()}
+    ids = numpy.array([song_ids.get((row['songTitle'], row['artist']), -1) for _, row in df.iterrows()],
+                      dtype=numpy.int64)
+    for i in numpy.nonzero(ids == -1)[0]:
+        print(i, df.iloc[i]['songTitle'], df.iloc[i]['artist'], 'not in the database')
+    return ids
+
+
+def load_distance_block(distances, song_ids, start, end, distance_type, threshold):
+    """
+    saves the similarities from the rows start to end of the distance matrix which are bigger than the threshold.
+    Each pair is taken only once (from the row with the higher index) and saved in both directions.
+    :param distances: the (memory-mapped) distance matrix
+    :param song_ids: the ids of the songs of the rows of the distance matrix, see get_useful_song_ids()
+    :param start: the first row of the block
+    :param end: the row after the last row of the block
+    :param distance_type: the distance type of the distance matrix
+    :param threshold: threshold for minimum similarity
+    :return: the number of saved pairs
+    """
+    block = numpy.asarray(distances[start:end])
+    rows, columns = numpy.nonzero(block >= threshold)
+    rows = rows + start
+    # the songs before 3218 are not in the application, each pair is only taken once
+    selected = (rows >= 3218) & (rows > columns) & (song_ids[rows] != -1) & (song_ids[columns] != -1)
+    rows, columns = rows[selected], columns[selected]
+    values = block[rows - start, columns]
+    selected = values != 0
+    rows, columns, values = rows[selected], columns[selected], values[selected]
+    return bulk_save_distances(song_ids[rows].tolist(), song_ids[columns].tolist(), values.tolist(), distance_type)
+
+
+def load_distances(distance_matrix, distance_type, threshold, block_size=1000):
     """
     an method used to load distances into the application. It is possible to only load distances for the 16594 songs in
     useful songs where the indexes of the songs have to correspond to the similarities in the distance matrix.
-    For each similarity, two instances of Distance are created and saved to the database.
+    For each similarity, two instances of Distance are created and saved to the database with bulk inserts, the matrix
+    is processed in blocks of block_size rows and the song ids are resolved with one query.
 
     :param distance_matrix: a matrix of shape 16594x16594 where on position i,j is the similarity between song on the
     ith line and jth line in the "useful songs" file
     :param distance_type: distance_Type is the type of measure this distance matrix was calculated based on, can be
     one of those in models.Distance.distance_Type
     :param threshold: threshold for minimum similarity, if lower, the Distance instance between two songs is not created
+    :param block_size: the number of rows of the distance matrix processed at once
     :return: None
 
     """
-    distances = numpy.load(distance_matrix)
-    distances[distances < threshold] = 0
-    indexes = numpy.transpose(numpy.nonzero(distances))
-    print(distance_type, 'has shape', indexes.shape)
-    df = pandas.read_csv("songRecommender_project/useful_songs", sep=';',
-                         names=['songTitle','artist'], index_col=False, header=None,
-                         engine='python', error_bad_lines=False)
-    for i in indexes:
-        if i[0] >= 3218:
-            if i[0] > i[1]:
-                try:
-                    song_1 = Song.objects.get(song_name=df.iloc[i[0]]['songTitle'], artist=df.iloc[i[0]]['artist'])
-                    song_2 = Song.objects.get(song_name=df.iloc[i[1]]['songTitle'], artist=df.iloc[i[1]]['artist'])
-
-                    distance, created = Distance.objects.get_or_create(song_1=song_1, song_2=song_2,
-                                                                       distance=distances[i[0]][i[1]],
-                                                                       distance_Type=distance_type)
-                    if created:
-                        distance_2 = Distance(song_1=song_2, song_2=song_1, distance=distances[i[0]][i[1]],
-                                              distance_Type=distance_type)
-                        distance_2.save()
-                        print(i[0], i[1],  distances[i[0]][i[1]])
-
-                except Exception as e:
-                    print(e)
-                    print(df.iloc[i[0]]['songTitle'], df.iloc[i[0]]['artist'], ' and ', df.iloc[i[1]]['songTitle'], df.iloc[i[1]]['artist'])
-
-                # print(i[0], distance_type)
+    distances = numpy.load(distance_matrix, mmap_mode='r')
+    song_ids = get_useful_song_ids()
+    for start in range(0, distances.shape[0], block_size):
+        end = min(start + block_size, distances.shape[0])
+        saved = load_distance_block(distances, song_ids, start, end, distance_type, threshold)
+        print(distance_type, 'rows', start, '-', end, saved, 'pairs saved')
     print(distance_type, 'saved')
 
 
@@ -53,29 +98,92 @@ def load_all_distances():
     """
     A one time function that can be used to load all distances for the 16594 songs in useful_songs into the database
     before the use of the web application.
-    Can be uncommented in views.py and then called when accessing a SongDetail view
+    The import_dataset management command loads them in parallel and can resume an interrupted import.
 
     :return: None
     """
-    load_distances('songRecommender_project/distances/pca_tf_idf_distances.npy', 'PCA_TF-idf', PCA_TF_IDF_THRESHOLD)
-    load_distances('songRecommender_project/distances/w2v_distances.npy', 'W2V', W2V_THRESHOLD)
-    load_distances('songRecommender_project/distances/pca_melspectrogram_distances.npy', 'PCA_MEL', PCA_MEL_THRESHOLD)
-    load_distances('songRecommender_project/distances/lstm_mfcc_distances.npy', 'LSTM_MFCC', LSTM_MFCC_THRESHOLD)
-    load_distances('songRecommender_project/distances/gru_mel_distances_5712.npy', 'GRU_MEL', GRU_MEL_THRESHOLD)
+    for distance_type, (distance_matrix, threshold) in DISTANCE_MATRICES.items():
+        load_distances(distance_matrix, distance_type, threshold)
 
 
 def load_all_representations():
     """
      A one time function that can be used to load all song representations for the 16594 songs in useful_songs
     into the database before the use of the web application.
-    Can be uncommented in views.py and then called when accessing a SongDetail view
+    The import_dataset management command loads them in parallel and can resume an interrupted import.
+    :return: None
+    """
+    for distance_type, (representation_matrix, field) in REPRESENTATION_MATRICES.items():
+        load_representations_to_db(representation_matrix, field)
+
+
+def save_representations_to_memmap(representation_matrix, distance_type):
+    """
+    a function that stores the representations of the songs from "useful_songs" as a memory-mapped file
+    (see songRecommender/Logic/memmap_representations.py) instead of exploding them into the database fields,
+    the song ids are resolved with a single query
+    :param representation_matrix: a matrix where in row i is the representation of the song on the ith line
+    from useful_songs
+    :param distance_type: the distance type the representations belong to
+    :return: None
+    """
+    representations = numpy.load(representation_matrix, mmap_mode='r')
+    song_ids = get_useful_song_ids()
+    rows = numpy.nonzero(song_ids != -1)[0]
+    ids = song_ids[rows]
+
+    MemmapRepresentations.create(distance_type, ids, representations[rows])
+    print(distance_type, len(ids), 'representations saved to memmap')
+
+
+def save_all_representations_to_memmap():
+    """
+    A one time function that stores the representations of all the 16594 songs in useful_songs as memory-mapped
+    files, which are then used by Song.get_*_representation() and the similarity tasks instead of the database
+    fields. The songs have to be loaded into the database first.
     :return: None
     """
-    load_pca_tf_idf_representations_to_db('songRecommender_project/representations/pca_tf_idf_representations.npy')
-    load_w2v_representations_to_db('songRecommender_project/representations/w2v_representations.npy')
-    load_pca_mel_representations_to_db('songRecommender_project/representations/pca_mel_representations.npy')
-    load_gru_mel_representations_to_db('songRecommender_project/representations/GRU_mel_representations_5712.npy')
-    load_lstm_mfcc_representations_to_db('songRecommender_project/representations/lstm_mfcc_representations.npy')
+    for distance_type, (representation_matrix, _) in REPRESENTATION_MATRICES.items():
+        save_representations_to_memmap(representation_matrix, distance_type)
+
+
+def load_representation_block(representations, song_ids, field, start, end):
+    """
+    saves the representations from the rows start to end of the representation matrix into the field of the songs,
+    all the songs of the block are updated by one bulk update in one transaction
+    :param representations: the (memory-mapped) representation matrix
+    :param song_ids: the ids of the songs of the rows of the matrix, see get_useful_song_ids()
+    :param field: the Song field the representations are saved into
+    :param start: the first row of the block
+    :param end: the row after the last row of the block
+    :return: the number of updated songs
+    """
+    songs = []
+    for i in range(start, end):
+        if song_ids[i] != -1:
+            song = Song(id=int(song_ids[i]))
+            setattr(song, field, representations[i])
+            songs.append(song)
+    with transaction.atomic():
+        Song.objects.bulk_update(songs, [field])
+    return len(songs)
+
+
+def load_representations_to_db(representation_matrix, field, block_size=500):
+    """
+    a function that loads the representation of each song from "useful_songs" into the database
+    :param representation_matrix: a matrix of shape 16594xN where in row i is the representation of the
+    song on the ith line from useful_songs
+    :param field: the Song field the representations are saved into
+    :param block_size: the number of songs updated at once
+    :return: None
+    """
+    representations = numpy.load(representation_matrix, mmap_mode='r')
+    song_ids = get_useful_song_ids()
+    for start in range(0, representations.shape[0], block_size):
+        end = min(start + block_size, representations.shape[0])
+        saved = load_representation_block(representations, song_ids, field, start, end)
+        print(field, 'rows', start, '-', end, saved, 'saved')
 
 
 def load_pca_tf_idf_representations_to_db(representation_matrix):
@@ -85,20 +193,7 @@ def load_pca_tf_idf_representations_to_db(representation_matrix):
     song on the ith line from useful_songs
     :return: None
     """
-    representations = numpy.load(representation_matrix)
-    df = pandas.read_csv("songRecommender_project/useful_songs", sep=';',
-                         names=['songTitle', 'artist'], index_col=False, header=None,
-                         engine='python', error_bad_lines=False)
-
-    for i, row in df.iterrows():
-        try:
-            song = Song.objects.get(song_name=row['songTitle'], artist=row['artist'])
-            song.pca_tf_idf_representation = representations[i].tolist()
-            song.save()
-            print(i)
-        except Exception as e:
-            print(str(e) + str(i) + 'pca_tf_idf')
-            print(i, row['songTitle'], row['artist'])
+    load_representations_to_db(representation_matrix, 'pca_tf_idf_representation')
 
 
 def load_w2v_representations_to_db(representation_matrix):
@@ -108,21 +203,7 @@ def load_w2v_representations_to_db(representation_matrix):
     song on the ith line from useful_songs
     :return: None
     """
-    representations = numpy.load(representation_matrix)
-    df = pandas.read_csv("songRecommender_project/useful_songs", sep=';',
-                         names=['songTitle', 'artist'], index_col=False, header=None,
-                         engine='python', error_bad_lines=False)
-
-    for i, row in df.iterrows():
-        try:
-            song = Song.objects.get(song_name=row['songTitle'], artist=row['artist'])
-            song.w2v_representation = representations[i].tolist()
-            song.save()
-            print(i)
-        except Exception as e:
-            print(str(e) + str(i) + 'w2v')
-            print(i, row['songTitle'], row['artist'])
-
+    load_representations_to_db(representation_matrix, 'w2v_representation')
 
 
 def load_lstm_mfcc_representations_to_db(representation_matrix):
@@ -132,20 +213,7 @@ def load_lstm_mfcc_representations_to_db(representation_matrix):
     song on the ith line from useful_songs
     :return: None
     """
-    representations = numpy.load(representation_matrix)
-    df = pandas.read_csv("songRecommender_project/useful_songs", sep=';',
-                         names=['songTitle', 'artist'], index_col=False, header=None,
-                         engine='python', error_bad_lines=False)
-
-    for i, row in df.iterrows():
-            try:
-                song = Song.objects.get(song_name=row['songTitle'], artist=row['artist'])
-                song.lstm_mfcc_representation = representations[i].tolist()
-                song.save()
-                print(i, 'lstm_saved')
-            except Exception as e:
-                print(str(e) + str(i) + 'lstm_mfcc')
-                print(i, row['songTitle'], row['artist'])
+    load_representations_to_db(representation_matrix, 'lstm_mfcc_representation')
 
 
 def load_pca_mel_representations_to_db(representation_matrix):
@@ -155,21 +223,7 @@ def load_pca_mel_representations_to_db(representation_matrix):
     song on the ith line from useful_songs
     :return: None
     """
-    representations = numpy.load(representation_matrix)
-    df = pandas.read_csv("songRecommender_project/useful_songs", sep=';',
-                         names=['songTitle', 'artist'], index_col=False, header=None,
-                         engine='python', error_bad_lines=False)
-
-    for i, row in df.iterrows():
-        try:
-            song = Song.objects.get(song_name=row['songTitle'], artist=row['artist'])
-            song.pca_mel_representation = representations[i].tolist()
-            song.save()
-            print(i, 'pca_mel')
-        except Exception as e:
-            print(str(e) + str(i) + 'pca_mel')
-            print(i, row['songTitle'], row['artist'])
-
+    load_representations_to_db(representation_matrix, 'pca_mel_representation')
 
 
 def load_gru_mel_representations_to_db(representation_matrix):
@@ -179,36 +233,34 @@ def load_gru_mel_representations_to_db(representation_matrix):
         song on the ith line from useful_songs
         :return: None
         """
-    representations = numpy.load(representation_matrix)
-    df = pandas.read_csv("songRecommender_project/useful_songs", sep=';',
-                         names=['songTitle', 'artist'], index_col=False, header=None,
-                         engine='python', error_bad_lines=False)
+    load_representations_to_db(representation_matrix, 'gru_mel_representation')
 
-    for i, row in df.iterrows():
-        try:
-            song = Song.objects.get(song_name=row['songTitle'], artist=row['artist'])
-            song.gru_mel_representation = representations[i].tolist()
-            song.save()
-            print(i, 'gru_mel')
-        except Exception as e:
-            print(str(e) + str(i) + 'gru_mel')
-            print(i, row['songTitle'], row['artist'])
 
-
-
-def load_songs_to_database():
+def load_songs_to_database(batch_size=1000, start=0):
     """
     a function that loads the songs from "useful_songs" into the database
     It has to be run before the song representations and distances are loaded into the database.
-    Can be uncommented in views.py and then called when accessing a SongDetail view.
-    :return: None
+    The songs are inserted in batches of batch_size songs, each batch in one transaction.
+    :param batch_size: the number of songs inserted by one statement
+    :param start: the number of songs at the beginning of the file which were already imported
+    :return: True if the songs were imported, False if the file has the wrong number of songs
     """
     df = pandas.read_csv("songRecommender_project/not_empty_songs_relative_path.txt", sep=';', header=None, index_col=False, names=['artist', 'title', 'lyrics', 'link', 'path'])
     if df.shape[0] == 16594:
-        for i, row in df.iterrows():
-            song = Song(song_name=row['title'], artist=row['artist'], text=row['lyrics'], link=row['link'],
-                        link_on_disc=row['path'])
-            song.save()
-            print('song', i, 'saved')
+        songs = []
+        for i, row in df.iloc[start:].iterrows():
+            songs.append(Song(song_name=row['title'], artist=row['artist'], text=row['lyrics'], link=row['link'],
+                              link_on_disc=row['path']))
+            if len(songs) == batch_size:
+                with transaction.atomic():
+                    Song.objects.bulk_create(songs)
+                songs = []
+                print('songs up to', i, 'saved')
+        with transaction.atomic():
+            Song.objects.bulk_create(songs)
+        print('all songs saved')
+        print(update_search_vectors(), 'search vectors computed')
+        return True
     else:
-        print("This datagframe has the wrong number of songs.")
\ No newline at end of file
+        print("This datagframe has the wrong number of songs.")
+        return False
@@ -0,0 +1,60 @@
+import base64
+
+import numpy
+from django.db import models
+
+"""this module contains the custom model fields of the application"""
+
+
+class Float32VectorField(models.BinaryField):
+    """
+    a field storing a vector (a song representation) as packed little-endian float32 values in a bytea column.
+    The value is read from the database by numpy.frombuffer without creating a Python float for each element,
+    so it is a read-only numpy array, anything numpy can turn into a vector can be saved into the field.
+
+    Attributes
+    ----------
+    dimension : int
+        the length of the stored vectors, checked when a vector is saved if it is not None
+    """
+    DTYPE = numpy.dtype('<f4')
+
+    def __init__(self, *args, dimension=None, **kwargs):
+        self.dimension = dimension
+        super(Float32VectorField, self).__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(Float32VectorField, self).deconstruct()
+        if self.dimension is not None:
+            kwargs['dimension'] = self.dimension
+        return name, path, args, kwargs
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return numpy.frombuffer(value, dtype=self.DTYPE)
+
+    def to_python(self, value):
+        if value is None or isinstance(value, numpy.ndarray):
+            return value
+        if isinstance(value, str):
+            # serialized by value_to_string
+            value = base64.b64decode(value.encode('ascii'))
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return numpy.frombuffer(value, dtype=self.DTYPE)
+        return numpy.asarray(value, dtype=self.DTYPE)
+
+    def get_prep_value(self, value):
+        if value is None:
+            return value
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return bytes(value)
+        vector = numpy.asarray(value, dtype=self.DTYPE).reshape([-1])
+        if self.dimension is not None and vector.shape[0] != self.dimension:
+            raise ValueError('%s expects vectors of length %d, got %d'
+                             % (self.name, self.dimension, vector.shape[0]))
+        return vector.tobytes()
+
+    def value_to_string(self, obj):
+        value = self.get_prep_value(self.value_from_object(obj))
+        return None if value is None else base64.b64encode(value).decode('ascii')
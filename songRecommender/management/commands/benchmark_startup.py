@@ -0,0 +1,32 @@
+import subprocess
+import sys
+import time
+
+from django.core.management.base import BaseCommand
+
+from songRecommender_project.settings import BASE_DIR
+
+
+class Command(BaseCommand):
+    """
+    measures how long it takes to start the project, each run is a new python process running a management
+    command (`check` by default), so the time includes the import of settings.py and of all the modules
+    of the application, as when the web server or a worker starts
+    """
+    help = 'Measures the startup time of the project'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--command', default='check', help='the management command which is started')
+        parser.add_argument('--repeat', type=int, default=5, help='the number of measured starts')
+
+    def handle(self, *args, **options):
+        times = []
+        for i in range(options['repeat']):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, 'manage.py'] + options['command'].split(), cwd=BASE_DIR,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+            times.append(time.perf_counter() - start)
+            self.stdout.write('run %d: %.2f s' % (i + 1, times[-1]))
+
+        self.stdout.write('min %.2f s, mean %.2f s, max %.2f s'
+                          % (min(times), sum(times) / len(times), max(times)))
@@ -0,0 +1,128 @@
+import json
+import os
+from multiprocessing import Pool
+
+import numpy
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from songRecommender.models import Song, update_search_vectors
+from songRecommender.data.load_distances import DISTANCE_MATRICES, REPRESENTATION_MATRICES, get_useful_song_ids, \
+    load_songs_to_database, load_distance_block, load_representation_block, save_representations_to_memmap
+from songRecommender_project.settings import BASE_DIR
+
+
+class Command(BaseCommand):
+    """
+    imports the songs, the representations of all the songs and the distances between them
+    from the files in songRecommender_project/ into the database.
+
+    The representations and the distances are imported in parallel with one process for each distance type,
+    the matrices are processed in blocks of rows, each block in one transaction. The blocks that were
+    imported are recorded in the state directory, so an interrupted import can be run again and it
+    continues with the blocks that are missing.
+    """
+    help = 'Imports the songs, their representations and the distances between them into the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--skip-songs', action='store_true', help='do not import the songs')
+        parser.add_argument('--skip-representations', action='store_true',
+                            help='do not import the representations')
+        parser.add_argument('--skip-distances', action='store_true', help='do not import the distances')
+        parser.add_argument('--memmap', action='store_true',
+                            help='also store the representations as memory-mapped files')
+        parser.add_argument('--block-size', type=int, default=500,
+                            help='the number of matrix rows imported in one transaction')
+        parser.add_argument('--processes', type=int, default=len(DISTANCE_MATRICES),
+                            help='the number of worker processes, one for each distance type by default')
+        parser.add_argument('--state-dir', default=os.path.join(BASE_DIR, 'import_state'),
+                            help='the directory where the imported blocks are recorded')
+        parser.add_argument('--restart', action='store_true',
+                            help='forget the recorded blocks and import everything again')
+
+    def handle(self, *args, **options):
+        os.makedirs(options['state_dir'], exist_ok=True)
+        if options['restart']:
+            for name in os.listdir(options['state_dir']):
+                os.remove(os.path.join(options['state_dir'], name))
+
+        if not options['skip_songs']:
+            # the songs are imported in batches, each in its own transaction, so an interrupted import
+            # continues after the songs which were already saved
+            songs_state = ImportState(os.path.join(options['state_dir'], 'songs.json'))
+            if 0 in songs_state:
+                self.stdout.write('songs are already imported, skipping')
+                # the songs imported before the search vectors were introduced get them now
+                self.stdout.write('%d search vectors computed' % update_search_vectors())
+            else:
+                imported = Song.objects.count()
+                self.stdout.write('importing songs from song %d' % imported)
+                if load_songs_to_database(start=imported):
+                    songs_state.add(0)
+
+        jobs = []
+        if not options['skip_representations']:
+            for distance_type, (representation_matrix, field) in REPRESENTATION_MATRICES.items():
+                jobs.append(('representations', distance_type, representation_matrix, field))
+        if not options['skip_distances']:
+            for distance_type, (distance_matrix, threshold) in DISTANCE_MATRICES.items():
+                jobs.append(('distances', distance_type, distance_matrix, threshold))
+        jobs = [job + (options['block_size'], options['state_dir']) for job in jobs]
+
+        # the worker processes have to open their own database connections
+        connections.close_all()
+        with Pool(processes=options['processes']) as pool:
+            for kind, distance_type, imported in pool.imap_unordered(import_matrix, jobs):
+                self.stdout.write(self.style.SUCCESS('%s %s imported, %d rows saved' % (distance_type, kind, imported)))
+
+        if options['memmap'] and not options['skip_representations']:
+            for distance_type, (representation_matrix, _) in REPRESENTATION_MATRICES.items():
+                save_representations_to_memmap(representation_matrix, distance_type)
+                self.stdout.write('%s representations stored as a memory-mapped file' % distance_type)
+
+
+def import_matrix(job):
+    """
+    imports the representation or distance matrix of one distance type block by block, runs in a worker process
+    :param job: a tuple (kind, distance type, matrix path, field or threshold, block size, state directory)
+    :return: (kind, distance type, the number of saved representations or pairs)
+    """
+    kind, distance_type, matrix_path, parameter, block_size, state_dir = job
+    state = ImportState(os.path.join(state_dir, '%s_%s_%d.json' % (kind, distance_type, block_size)))
+    matrix = numpy.load(matrix_path, mmap_mode='r')
+    song_ids = get_useful_song_ids()
+
+    imported = 0
+    blocks = range(0, matrix.shape[0], block_size)
+    for number, start in enumerate(blocks):
+        if start in state:
+            continue
+        end = min(start + block_size, matrix.shape[0])
+        if kind == 'representations':
+            imported = imported + load_representation_block(matrix, song_ids, parameter, start, end)
+        else:
+            imported = imported + load_distance_block(matrix, song_ids, start, end, distance_type, parameter)
+        state.add(start)
+        print('%s %s: block %d/%d done' % (distance_type, kind, number + 1, len(blocks)), flush=True)
+    return kind, distance_type, imported
+
+
+class ImportState:
+    """the starting rows of the blocks of one matrix that were already imported, stored in a json file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.blocks = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.blocks = set(json.load(f))
+
+    def __contains__(self, start):
+        return start in self.blocks
+
+    def add(self, start):
+        self.blocks.add(start)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(sorted(self.blocks), f)
+        os.replace(temp_path, self.path)
@@ -1,13 +1,85 @@
 from django.db import models
 from django.contrib.auth.models import User
 from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
 from django.urls import reverse
 from django.db.models.signals import post_save
 from django.dispatch import receiver
-from songRecommender_project.settings import EMAIL_DISABLED, SELECTED_DISTANCE_TYPE
+from songRecommender_project.settings import EMAIL_DISABLED, SELECTED_DISTANCE_TYPE, SYMMETRIC_DISTANCE_STORAGE
+from songRecommender.Logic.memmap_representations import get_memmap_representations
+from songRecommender.fields import Float32VectorField
 
 import numpy
 
+# a short name of each distance type used in the names of the indexes built for one distance type
+DISTANCE_TYPE_INDEX_NAMES = (
+    ('PCA_TF-idf', 'tfidf'),
+    ('W2V', 'w2v'),
+    ('PCA_MEL', 'pcamel'),
+    ('GRU_MEL', 'grumel'),
+    ('LSTM_MFCC', 'lstm'),
+)
+
+
+# the fields of a song shown in the lists of songs, the representations and the lyrics are never needed there
+SONG_DISPLAY_FIELDS = ['id', 'song_name', 'artist']
+
+
+def song_display_fields(relation):
+    """:returns the names of SONG_DISPLAY_FIELDS of the song in the relation, to be used in only()"""
+    return ['%s__%s' % (relation, field) for field in SONG_DISPLAY_FIELDS]
+
+
+def per_distance_type_indexes(prefix, fields):
+    """
+    :returns a partial index over the fields for each distance type, each of them only contains the rows of
+    its distance type, so a query for one distance type only reads the (much smaller) index of that type
+    """
+    return [models.Index(fields=fields, name='%s_%s_idx' % (prefix, name),
+                         condition=models.Q(distance_Type=distance_type))
+            for distance_type, name in DISTANCE_TYPE_INDEX_NAMES]
+
+
+# the Song field the representation of each distance type is stored in
+SONG_REPRESENTATION_FIELDS = {
+    'PCA_TF-idf': 'pca_tf_idf_representation',
+    'W2V': 'w2v_representation',
+    'PCA_MEL': 'pca_mel_representation',
+    'GRU_MEL': 'gru_mel_representation',
+    'LSTM_MFCC': 'lstm_mfcc_representation',
+}
+
+
+class SongQuerySet(models.QuerySet):
+    """queryset of songs which can load the fields the Song manager defers"""
+
+    def _undefer(self, fields):
+        deferred, defer = self.query.deferred_loading
+        if not defer:
+            # only() was used, the fields are added to the loaded ones
+            return self.only(*(set(deferred) | set(fields)))
+        return self.defer(None).defer(*(set(deferred) - set(fields)))
+
+    def with_representations(self, *distance_types):
+        """:returns the songs with the representations of the distance types loaded, of all of them if none is given"""
+        return self._undefer([SONG_REPRESENTATION_FIELDS[distance_type]
+                              for distance_type in distance_types or SONG_REPRESENTATION_FIELDS])
+
+    def with_text(self):
+        """:returns the songs with their lyrics loaded"""
+        return self._undefer(['text'])
+
+
+class SongManager(models.Manager.from_queryset(SongQuerySet)):
+    """the default manager of Song, it defers the representations and the lyrics, which are only needed when
+    the similarities are calculated, they can be loaded with with_representations() and with_text()"""
+
+    def get_queryset(self):
+        return super(SongManager, self).get_queryset().defer('text', 'search_vector',
+                                                             *SONG_REPRESENTATION_FIELDS.values())
+
+
 class Song(models.Model):
     """a model representing the Song table in the database,
     stores the song name, artist, lyrics and link and also the distance to other songs"""
@@ -22,28 +94,54 @@ class Song(models.Model):
     audio = models.BooleanField(default=False)
     lyrics = models.BooleanField(default=True)
 
-    # representations of the implemented methods for each song
-    pca_tf_idf_representation = ArrayField(models.FloatField(), null=True)
-    w2v_representation = ArrayField(models.FloatField(), null=True)
-    lstm_mfcc_representation = ArrayField(models.FloatField(), null=True)
-    pca_mel_representation = ArrayField(models.FloatField(), null=True)
-    gru_mel_representation = ArrayField(models.FloatField(), null=True)
+    # representations of the implemented methods for each song, stored as packed float32 values
+    pca_tf_idf_representation = Float32VectorField(null=True, dimension=4457)
+    w2v_representation = Float32VectorField(null=True, dimension=300)
+    lstm_mfcc_representation = Float32VectorField(null=True, dimension=5168)
+    pca_mel_representation = Float32VectorField(null=True, dimension=320)
+    gru_mel_representation = Float32VectorField(null=True, dimension=5712)
+
+    # the full text search vector of the artist, the song name and the lyrics, see SONG_SEARCH_VECTOR
+    search_vector = SearchVectorField(null=True)
+
+    objects = SongManager()
+
+    class Meta:
+        # the songs of foreign keys are loaded by the manager too, so without their representations
+        base_manager_name = 'objects'
+        indexes = [
+            GinIndex(fields=['search_vector'], name='song_search_vector_idx'),
+            # the trigram indexes find the songs whose name or artist is similar to a query with a typo
+            GinIndex(fields=['song_name'], name='song_name_trgm_idx', opclasses=['gin_trgm_ops']),
+            GinIndex(fields=['artist'], name='song_artist_trgm_idx', opclasses=['gin_trgm_ops']),
+        ]
+
+    ### loading representations from the memory-mapped files or from the database
+    def get_representation(self, distance_type, field, dimension):
+        """
+        :returns the representation of the distance type as a [1, dimension] array, it is read from the
+        memory-mapped representation file without a copy if the song is stored there,
+        otherwise it is loaded from the field of the song
+        """
+        memmap = get_memmap_representations(distance_type)
+        if memmap is not None and self.pk in memmap:
+            return memmap.get(self.pk).reshape([1, dimension])
+        return numpy.asarray(getattr(self, field), dtype=numpy.float32).reshape([1, dimension])
 
-    ### loading representations from the database
     def get_pca_tf_idf_representation(self):
-        return numpy.array(self.pca_tf_idf_representation).reshape([1, 4457])
+        return self.get_representation('PCA_TF-idf', 'pca_tf_idf_representation', 4457)
 
     def get_W2V_representation(self):
-        return numpy.array(self.w2v_representation, dtype=float).reshape([1,300])
+        return self.get_representation('W2V', 'w2v_representation', 300)
 
     def get_lstm_mfcc_representation(self):
-        return numpy.array(self.lstm_mfcc_representation, dtype=float).reshape([1,5168])
+        return self.get_representation('LSTM_MFCC', 'lstm_mfcc_representation', 5168)
 
     def get_pca_mel_representation(self):
-        return numpy.array(self.pca_mel_representation, dtype=float).reshape([1,320])
+        return self.get_representation('PCA_MEL', 'pca_mel_representation', 320)
 
     def get_gru_mel_representation(self):
-        return numpy.array(self.gru_mel_representation, dtype=float).reshape([1,5712])
+        return self.get_representation('GRU_MEL', 'gru_mel_representation', 5712)
 
 
     def __str__(self):
@@ -51,11 +149,37 @@ class Song(models.Model):
 
     def get_distance_to_other_songs(self):
         """
-        :returns: the distance to of other song to this song
+        :returns: the other songs similar to this song, from the most similar one, read in both directions
+        of the Distance table by Distance.objects.neighbours, so also with the symmetric storage
         """
-        return self.distance_to_other_songs.filter(song_2__distance_Type=SELECTED_DISTANCE_TYPE).order_by(
-            'song_2').exclude(id=self.id)
+        return [distance.song_1 for distance in Distance.objects.neighbours(self.pk, SELECTED_DISTANCE_TYPE)
+                if distance.song_1.pk != self.pk]
+
+
 
+# the search vector stored in Song.search_vector, the lyrics weigh less than the artist and the song name
+SONG_SEARCH_VECTOR = SearchVector('artist', weight='A') + SearchVector('song_name', weight='A') + \
+                     SearchVector('text', weight='C')
+
+
+@receiver(post_save, sender=Song)
+def update_song_search_vector(sender, instance, update_fields=None, **kwargs):
+    """when a song is saved its search vector is computed again from the saved fields"""
+    if update_fields is not None and not {'artist', 'song_name', 'text'} & set(update_fields):
+        return
+    Song.objects.filter(pk=instance.pk).update(search_vector=SONG_SEARCH_VECTOR)
+
+
+def update_search_vectors(songs=None):
+    """
+    computes the search vectors of the songs with one update, used after the songs are inserted without
+    the post_save signal (by bulk_create)
+    :param songs: a queryset of the songs, the songs without a search vector if None
+    :return: the number of updated songs
+    """
+    if songs is None:
+        songs = Song.objects.filter(search_vector=None)
+    return songs.update(search_vector=SONG_SEARCH_VECTOR)
 
 
 class Profile(models.Model):
@@ -118,11 +242,14 @@ class List(models.Model):
         return reverse('list_detail', args=[str(self.id)])
 
     def get_nearby_songs(self):
-        list_user = Profile.objects.get(user_id=self.user_id)
-        played_songs = Played_Song.objects.all().filter(user_id=list_user.pk)
-
-        nearby_songs = Distance_to_List.objects.filter(list_id=self.pk, distance_Type=list_user.user_selected_distance_type
-                                                       ).exclude(song_id_id__in=played_songs.values_list('song_id1_id', flat=True)).exclude()
+        # the distance type selected by the user and his played songs are subqueries of the single query
+        distance_type = Profile.objects.filter(user_id=self.user_id_id).values('user_selected_distance_type')[:1]
+        played_songs = Played_Song.objects.filter(user_id__user=self.user_id_id)
+
+        nearby_songs = Distance_to_List.objects.filter(list_id=self.pk, distance_Type=models.Subquery(distance_type)
+                                                       ).exclude(song_id_id__in=played_songs.values_list('song_id1_id', flat=True)
+                                                                 ).select_related('song_id').only(
+            'id', 'song_id', *song_display_fields('song_id'))
         return nearby_songs
 
 
@@ -170,12 +297,47 @@ class Played_Song(models.Model):
     class Meta:
         unique_together = (('song_id1', 'user_id'))
 
+class DistanceManager(models.Manager):
+    """
+    manager of the Distance table which finds the neighbours of a song regardless of whether each pair
+    is stored in both directions or only once (SYMMETRIC_DISTANCE_STORAGE in settings.py)
+    """
+
+    def neighbours(self, song_id, distance_type, exclude_song_ids=None, count=None):
+        """
+        :returns the songs most similar to the song specified by song_id as Distance objects whose song_1 is
+        the neighbour and song_2 the song, sorted from the most similar neighbour. With the symmetric storage
+        the pairs where the song is song_1 and where it is song_2 are read by a union of the two directions.
+        :param song_id: the id of the song whose neighbours are returned
+        :param distance_type: the distance type of the similarities
+        :param exclude_song_ids: a list or a queryset of ids of songs which are not returned
+        :param count: the maximal number of returned neighbours, all of them if None
+        """
+        neighbours = self.filter(distance_Type=distance_type, song_2_id=song_id)
+        if exclude_song_ids is not None:
+            neighbours = neighbours.exclude(song_1_id__in=exclude_song_ids)
+        neighbours = neighbours.values_list('song_1_id', 'distance').order_by()
+        if SYMMETRIC_DISTANCE_STORAGE:
+            other_direction = self.filter(distance_Type=distance_type, song_1_id=song_id)
+            if exclude_song_ids is not None:
+                other_direction = other_direction.exclude(song_2_id__in=exclude_song_ids)
+            neighbours = neighbours.union(other_direction.values_list('song_2_id', 'distance').order_by(), all=True)
+        neighbours = list(neighbours.order_by('-distance')[:count])
+
+        songs = Song.objects.only(*SONG_DISPLAY_FIELDS).in_bulk([neighbour_id for neighbour_id, _ in neighbours])
+        return [Distance(song_1=songs[neighbour_id], song_2_id=song_id, distance=distance, distance_Type=distance_type)
+                for neighbour_id, distance in neighbours if neighbour_id in songs]
+
+
 class Distance(models.Model):
     """
     class representing the distance table in the database
     stores the distance between songs song_1 and song_2
     there can be more distance types added
 
+    with SYMMETRIC_DISTANCE_STORAGE each pair is stored only once with song_1 < song_2,
+    the neighbours of a song are then read with Distance.objects.neighbours()
+
     for each distance type there is a method to calculate the distance
     in songRecommender_project/tasks.py
     """
@@ -191,12 +353,17 @@ class Distance(models.Model):
     )
     distance_Type = models.CharField(max_length=20, choices=DISTANCE_CHOICES)
 
+    objects = DistanceManager()
+
     def __str__(self):
         return str(self.song_1.artist) + " - " + str(self.song_1.song_name)
 
     class Meta:
         ordering = ['-distance']
         unique_together = (('song_1', 'song_2', 'distance_Type'))
+        # the songs nearby a song (SongDetailView) are read in the order of the index of their distance type,
+        # song_1 is included so the rows do not have to be fetched from the table
+        indexes = per_distance_type_indexes('distance_song_2', ['song_2', '-distance', 'song_1'])
 
 
 class Distance_to_List(models.Model):
@@ -227,6 +394,9 @@ class Distance_to_List(models.Model):
     class Meta:
         ordering = ['-distance']
         unique_together=(('list_id', 'song_id', 'distance_Type'))
+        # the songs nearby a list (ListDetailView, List.get_nearby_songs) are read in the order of the index
+        indexes = [models.Index(fields=['list_id', 'distance_Type', '-distance', 'song_id'],
+                                name='dist_to_list_list_type_idx')]
     
 
 class Distance_to_User(models.Model):
@@ -254,6 +424,86 @@ class Distance_to_User(models.Model):
     class Meta:
         ordering = ['-distance']
         unique_together=(('user_id', 'song_id', 'distance_Type'))
+        # the songs recommended to a user (rebuild_top_recommendations) are read in the order of the index
+        # of their distance type
+        indexes = per_distance_type_indexes('dist_to_user', ['user_id', '-distance', 'song_id'])
 
     def __str__(self):
         return self.song_id.artist + ' - ' + self.song_id.song_name
+
+
+class Pending_Recalculation(models.Model):
+    """
+    class representing the pending_recalculation table in the database
+    stores a song whose similarities to a user (or his lists) have to be recalculated
+
+    the rows are added by songRecommender_project/tasks.py schedule_recalculation when the user plays,
+    likes or dislikes a song or adds it to a list and they are all applied at once and deleted by
+    flush_pending_recalculations after a short debounce window
+    """
+    user_id = models.ForeignKey(User, on_delete=models.CASCADE)
+    song_id = models.ForeignKey(Song, on_delete=models.CASCADE)
+    list_id = models.ForeignKey(List, on_delete=models.CASCADE, null=True)
+    RECALCULATION_CHOICES = (
+            ('USER', 'Distances to the user'),
+            ('LISTS', 'Distances to all lists of the user'),
+            ('LIST', 'Distances to one list')
+    )
+    recalculation_Type = models.CharField(max_length=10, choices=RECALCULATION_CHOICES)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['created']
+
+    def __str__(self):
+        return str(self.user_id) + ' - ' + self.recalculation_Type
+
+
+class Pending_Feature_Extraction(models.Model):
+    """
+    class representing the pending_feature_extraction table in the database
+    stores an added song whose representations have not been computed yet
+
+    the rows are added by songRecommender_project/tasks.py handle_added_song and the representations
+    of up to FEATURE_EXTRACTION_BATCH_SIZE songs are computed at once and the rows deleted by
+    extract_pending_features after a short batching window
+    """
+    song_id = models.ForeignKey(Song, on_delete=models.CASCADE)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['created']
+
+    def __str__(self):
+        return str(self.song_id)
+
+
+class User_Top_Recommendations(models.Model):
+    """
+    class representing the user_top_recommendations table in the database
+    stores the ids and the similarities of the songs most similar to a user for one distance type,
+    sorted from the most similar song and without the songs the user already played
+
+    the rows are maintained by songRecommender/Logic/top_recommendations.py when the similarities
+    of the songs to the user are recalculated, so the recommendations are read from one row
+    instead of sorting all the Distance_to_User rows of the user
+    """
+    user_id = models.ForeignKey(User, on_delete=models.CASCADE)
+    DISTANCE_CHOICES = (
+            ('PCA_TF-idf', 'PCA on TF-idf'),
+            ('W2V', 'Word2Vec'),
+            ('PCA_MEL', 'PCA on mel-spectrograms'),
+            ('GRU_MEL', 'GRU neural network with mel-spectrogram input'),
+            ('LSTM_MFCC', 'LSTM autoencoder with MFCC input')
+    )
+    distance_Type = models.CharField(max_length=20, choices=DISTANCE_CHOICES)
+    song_ids = ArrayField(models.IntegerField(), default=list)
+    distances = ArrayField(models.FloatField(), default=list)
+    # True if a played song was removed from the full top, it is computed again by the next recalculation
+    refill = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = (('user_id', 'distance_Type'))
+
+    def __str__(self):
+        return str(self.user_id) + ' - ' + self.distance_Type
@@ -0,0 +1,146 @@
+import base64
+import json
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+from songRecommender_project.settings import KEYSET_PAGINATION
+
+"""this module contains the keyset pagination used by the views listing songs"""
+
+
+class KeysetPage:
+    """
+    one page of a keyset paginated list, instead of a page number the page knows the tokens
+    of the pages before and after it
+
+    Attributes
+    ----------
+    object_list : list
+        the objects on the page
+    next_token : str
+        the token of the next page, None if this is the last page
+    previous_token : str
+        the token of the previous page, None if this is the first page
+    """
+
+    def __init__(self, object_list, next_token, previous_token):
+        self.object_list = object_list
+        self.next_token = next_token
+        self.previous_token = previous_token
+
+    def has_next(self):
+        return self.next_token is not None
+
+    def has_previous(self):
+        return self.previous_token is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def encode_token(values):
+    """:returns the opaque url safe token of the values of the ordering fields of an object"""
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_token(token):
+    """:returns the values of the ordering fields encoded in the token, None if the token is not valid"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+    except (ValueError, UnicodeError):
+        return None
+    return values if isinstance(values, list) else None
+
+
+class KeysetPaginationMixin:
+    """
+    mixin of a ListView which pages through the list by the values of the ordering fields of the last
+    (or the first) shown object instead of the page number, so a page is found by an index scan
+    and a deep page costs the same as the first one, no rows are counted or skipped with OFFSET.
+    The pages are linked by the ?after= and ?before= tokens.
+
+    With KEYSET_PAGINATION set to False in settings.py the numbered pages of django's Paginator are used.
+
+    Attributes
+    ----------
+    keyset_ordering : tuple
+        the fields the list is ordered by, the last one has to be unique ('-' for a descending order)
+    page_window : int
+        the number of page numbers shown on each side of the current page in the numbered mode
+    """
+    keyset_ordering = ('id',)
+    page_window = 3
+
+    def paginate_queryset(self, queryset, page_size):
+        if not KEYSET_PAGINATION:
+            return super(KeysetPaginationMixin, self).paginate_queryset(queryset, page_size)
+
+        after = self._decode_values(queryset.model, self.request.GET.get('after', ''))
+        before = self._decode_values(queryset.model, self.request.GET.get('before', ''))
+        ordering = list(self.keyset_ordering)
+        if before is not None:
+            # the previous page is read backwards from the first object of the current page
+            ordering = [field[1:] if field.startswith('-') else '-' + field for field in ordering]
+            queryset = queryset.filter(self._keyset_filter(ordering, before))
+        elif after is not None:
+            queryset = queryset.filter(self._keyset_filter(ordering, after))
+
+        # one more object is read to know if there is another page
+        objects = list(queryset.order_by(*ordering)[:page_size + 1])
+        more = len(objects) > page_size
+        objects = objects[:page_size]
+        if before is not None:
+            objects.reverse()
+
+        next_token = previous_token = None
+        if objects:
+            if more or before is not None:
+                next_token = encode_token(self._keyset_values(objects[-1]))
+            if (more and before is not None) or after is not None:
+                previous_token = encode_token(self._keyset_values(objects[0]))
+        page = KeysetPage(objects, next_token, previous_token)
+        return None, page, objects, page.has_other_pages()
+
+    def get_context_data(self, **kwargs):
+        context = super(KeysetPaginationMixin, self).get_context_data(**kwargs)
+        context['keyset_pagination'] = KEYSET_PAGINATION
+        if not KEYSET_PAGINATION and context.get('page_obj') is not None:
+            context['start_page'] = context['page_obj'].number - self.page_window
+            context['end_page'] = context['page_obj'].number + self.page_window
+        return context
+
+    def _decode_values(self, model, token):
+        """
+        :returns the values of the ordering fields encoded in the token converted to the types of the fields,
+        None if the token is not valid, so a changed or malformed token shows the first page
+        """
+        values = decode_token(token)
+        if values is None or len(values) != len(self.keyset_ordering):
+            return None
+        try:
+            values = [model._meta.get_field(field.lstrip('-')).to_python(value)
+                      for field, value in zip(self.keyset_ordering, values)]
+        except ValidationError:
+            return None
+        return None if None in values else values
+
+    def _keyset_values(self, obj):
+        return [getattr(obj, field.lstrip('-')) for field in self.keyset_ordering]
+
+    def _keyset_filter(self, ordering, values):
+        """:returns the condition of the objects which follow the object with the values in the ordering"""
+        condition = Q()
+        equal = Q()
+        for field, value in zip(ordering, values):
+            name = field.lstrip('-')
+            lookup = '__lt' if field.startswith('-') else '__gt'
+            condition = condition | (equal & Q(**{name + lookup: value}))
+            equal = equal & Q(**{name: value})
+        return condition
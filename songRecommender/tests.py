@@ -1,3 +1,353 @@
-from django.test import TestCase
+import os
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+import numpy
+from django.test import TestCase, override_settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.urls import reverse
+
+from songRecommender.models import Song, List, Song_in_List, Played_Song, Distance, Distance_to_User, \
+    Distance_to_List, User_Top_Recommendations
+from songRecommender.Logic.distance_sql import upsert_distances_to_user, upsert_distances_to_users, \
+    upsert_distances_to_list, upsert_added_song_distances_to_lists
+from songRecommender.Logic.top_recommendations import get_top_recommendations, merge_top_recommendations
+from songRecommender.Logic.song_search import prefix_query, search_songs
+from songRecommender.pagination import encode_token
+from songRecommender.Logic import feature_cache
+from songRecommender.Logic.adding_songs import retrieve_audio_features
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class DistanceIndexTests(TestCase):
+    """
+    checks that the queries the views run to read the most similar songs from the Distance tables use the composite
+    indexes of the tables. The queries are captured while the views are requested and explained afterwards,
+    so a changed query of a view is checked too. The test tables are small, so sequential scans are disabled
+    for the planner, otherwise it would always choose them, the test then fails only if no index can answer the query
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='user', password='password')
+        cls.user.profile.user_selected_distance_type = 'W2V'
+        cls.user.profile.save()
+        cls.songs = [Song.objects.create(song_name='song %d' % i, artist='artist', text='', link='')
+                     for i in range(10)]
+        cls.list = List.objects.create(name='list', user_id=cls.user)
+        Song_in_List.objects.create(list_id=cls.list, song_id=cls.songs[0])
+        Played_Song.objects.create(user_id=cls.user.profile, song_id1=cls.songs[0], opinion=1)
+        for i, song in enumerate(cls.songs[1:]):
+            Distance.objects.create(song_1=cls.songs[0], song_2=song, distance=i / 10, distance_Type='W2V')
+            Distance.objects.create(song_1=song, song_2=cls.songs[0], distance=i / 10, distance_Type='W2V')
+            Distance_to_User.objects.create(user_id_id=cls.user.pk, song_id=song, distance=i / 10,
+                                            distance_Type='W2V')
+            Distance_to_List.objects.create(list_id=cls.list, song_id=song, distance=i / 10, distance_Type='W2V')
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+        with connection.cursor() as cursor:
+            cursor.execute('SET enable_seqscan = off')
+
+    def assertViewQueryUsesIndex(self, url, model, index_name):
+        """requests the url and checks the plan of the ordered query the view ran on the table of the model"""
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        table = 'FROM %s' % connection.ops.quote_name(model._meta.db_table)
+        sqls = [query['sql'] for query in queries.captured_queries
+                if table in query['sql'] and 'ORDER BY' in query['sql']]
+        self.assertTrue(sqls, 'the view did not read %s' % model._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN ' + sqls[0])
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+        self.assertNotIn('Seq Scan', plan)
+        self.assertIn(index_name, plan)
+
+    def test_songs_nearby_song_use_index(self):
+        self.assertViewQueryUsesIndex(reverse('song_detail', args=[self.songs[0].pk]), Distance,
+                                      'distance_song_2_w2v_idx')
+
+    def test_songs_nearby_list_use_index(self):
+        self.assertViewQueryUsesIndex(reverse('list_detail', args=[self.list.pk]), Distance_to_List,
+                                      'dist_to_list_list_type_idx')
+
+    def test_songs_nearby_user_use_index(self):
+        # the recommendations of the home page are not cached yet, so the top recommendations are computed
+        self.assertViewQueryUsesIndex(reverse('index'), Distance_to_User, 'dist_to_user_w2v_idx')
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class PageQueryCountTests(TestCase):
+    """
+    checks that the pages showing lists of songs run a fixed number of queries, so no query is run for each
+    shown song. The recommendations are cached by the first request of setUp, the counts are of a warm cache.
+    Each count includes the queries loading the session and the user.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='user', password='password')
+        cls.user.profile.user_selected_distance_type = 'W2V'
+        cls.user.profile.save()
+        cls.songs = [Song.objects.create(song_name='song %d' % i, artist='artist', text='', link='')
+                     for i in range(10)]
+        cls.list = List.objects.create(name='list', user_id=cls.user)
+        Song_in_List.objects.create(list_id=cls.list, song_id=cls.songs[0])
+        Played_Song.objects.create(user_id=cls.user.profile, song_id1=cls.songs[0], opinion=1)
+        Played_Song.objects.create(user_id=cls.user.profile, song_id1=cls.songs[1], opinion=0)
+        for i, song in enumerate(cls.songs[2:]):
+            Distance.objects.create(song_1=song, song_2=cls.songs[1], distance=i / 10, distance_Type='W2V')
+            Distance_to_User.objects.create(user_id_id=cls.user.pk, song_id=song, distance=i / 10,
+                                            distance_Type='W2V')
+            Distance_to_List.objects.create(list_id=cls.list, song_id=song, distance=i / 10, distance_Type='W2V')
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+        self.client.get(reverse('index'))
+
+    def test_home_page(self):
+        with self.assertNumQueries(5):
+            self.client.get(reverse('index'))
+
+    def test_song_detail(self):
+        # the song was already played, so only the number of its plays is updated
+        with self.assertNumQueries(9):
+            self.client.get(reverse('song_detail', args=[self.songs[1].pk]))
+
+    def test_list_detail(self):
+        # the keyset pagination does not count the songs of the list
+        with self.assertNumQueries(6):
+            self.client.get(reverse('list_detail', args=[self.list.pk]))
+
+    def test_my_lists(self):
+        # the nearby songs of all the lists are read by one query
+        other_list = List.objects.create(name='other list', user_id=self.user)
+        for i, song in enumerate(self.songs[2:]):
+            Distance_to_List.objects.create(list_id=other_list, song_id=song, distance=i / 10, distance_Type='W2V')
+        with self.assertNumQueries(8):
+            response = self.client.get(reverse('my_lists'))
+        self.assertEqual([len(l.shown_nearby_songs) for l in response.context['moje_listy']], [8, 8])
+
+    def test_recommended_songs(self):
+        with self.assertNumQueries(5):
+            self.client.get(reverse('recommended_songs'))
+
+
+class KeysetPaginationTests(TestCase):
+    """checks that paging forward and backward through all the songs with the tokens shows every song once"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='user', password='password')
+        cls.songs = [Song.objects.create(song_name='song %d' % i, artist='artist', text='', link='')
+                     for i in range(40)]
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def test_pages_forward_and_backward(self):
+        pages = [self.client.get(reverse('all_songs')).context['page_obj']]
+        while pages[-1].has_next():
+            pages.append(self.client.get(reverse('all_songs'), {'after': pages[-1].next_token}).context['page_obj'])
+        shown = [song.pk for page in pages for song in page]
+        self.assertEqual(shown, [song.pk for song in self.songs])
+        self.assertFalse(pages[0].has_previous())
+
+        previous = self.client.get(reverse('all_songs'), {'before': pages[-1].previous_token}).context['page_obj']
+        self.assertEqual([song.pk for song in previous], [song.pk for song in pages[-2]])
+
+    def test_invalid_tokens_show_first_page(self):
+        first = [song.pk for song in self.client.get(reverse('all_songs')).context['page_obj']]
+        for values in [['x'], [1, 2], [None], [[1]], {'id': 1}]:
+            response = self.client.get(reverse('all_songs'), {'after': encode_token(values)})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([song.pk for song in response.context['page_obj']], first)
+
+
+class SongSearchTests(TestCase):
+    """checks the full text search of the songs with its trigram fallback and the search vectors they use"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.song = Song.objects.create(song_name='Bohemian Rhapsody', artist='Queen', text='is this the real life',
+                                       link='')
+        Song.objects.create(song_name='Yellow Submarine', artist='The Beatles', text='we all live', link='')
+
+    def test_prefix_query(self):
+        self.assertIsNone(prefix_query(''))
+        self.assertIsNone(prefix_query(' ?!, '))
+        self.assertEqual(prefix_query("rock'n roll!").value, 'rock & n & roll:*')
+
+    def test_prefix_match(self):
+        self.assertEqual(search_songs('bohem'), [self.song])
+        self.assertEqual(search_songs('queen bohemian rhaps'), [self.song])
+
+    def test_trigram_fallback(self):
+        # the typo is not matched by the full text search
+        self.assertEqual(search_songs('Bohemain Rapsody'), [self.song])
+
+    def test_trigram_fallback_excludes_found_songs(self):
+        # the artist matches by full text and by trigrams, the song is returned once
+        self.assertEqual(search_songs('Queen'), [self.song])
+
+    def test_search_vector_updated_on_save(self):
+        self.song.song_name = 'Killer Queen'
+        self.song.save()
+        self.assertTrue(Song.objects.filter(pk=self.song.pk, search_vector='killer').exists())
+        self.assertFalse(Song.objects.filter(pk=self.song.pk, search_vector='rhapsody').exists())
+
+
+class FeatureCacheTests(TestCase):
+    """checks that the audio features of a downloaded song are read from the feature cache without decoding it"""
+
+    def setUp(self):
+        self.media_root = tempfile.TemporaryDirectory()
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media_root.cleanup)
+        self.addCleanup(self.cache_dir.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        cache_dir_patch = mock.patch.object(feature_cache, 'FEATURE_CACHE_DIR', self.cache_dir.name)
+        cache_dir_patch.start()
+        self.addCleanup(cache_dir_patch.stop)
+
+    def test_cached_features_of_downloaded_song(self):
+        # the file name is set the same way download_song_from_youtube sets it
+        with open(os.path.join(self.media_root.name, 'song title.mp3'), 'wb') as f:
+            f.write(b'not decoded')
+        song = Song.objects.create(song_name='song title', artist='artist', text='', link='', audio=True)
+        song.link_on_disc = 'song title' + '.mp3'
+        song.save()
+
+        mel_spectrogram = numpy.random.rand(408, 320).astype(numpy.float32)
+        mfcc = numpy.random.rand(646, 128).astype(numpy.float32)
+        feature_cache.cache_features(feature_cache.file_hash(song.link_on_disc.path), mel_spectrogram, mfcc)
+
+        with mock.patch('songRecommender.Logic.adding_songs.get_audio_data') as get_audio_data:
+            cached_mel_spectrogram, cached_mfcc = retrieve_audio_features(Song.objects.get(pk=song.pk))
+        get_audio_data.assert_not_called()
+        numpy.testing.assert_array_equal(cached_mel_spectrogram, mel_spectrogram)
+        numpy.testing.assert_array_equal(cached_mfcc, mfcc)
+
+
+class DistanceUpsertTests(TestCase):
+    """
+    checks the similarities the statements of songRecommender/Logic/distance_sql.py save to the Distance_to_User
+    and Distance_to_List tables against values computed by hand. The similarities are powers of two,
+    so the sums are exact. The pairs of songs are stored in both directions, SymmetricDistanceUpsertTests
+    runs the same tests with each pair stored once
+    """
+    symmetric = False
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='user', password='password')
+        cls.other_user = User.objects.create_user(username='other', password='password')
+        cls.songs = [Song.objects.create(song_name='song %d' % i, artist='artist', text='', link='')
+                     for i in range(6)]
+        s = cls.songs
+        # the weight of a neighbour is (opinion + 1) if the user played it, 1 otherwise
+        Played_Song.objects.create(user_id=cls.user.profile, song_id1=s[1], opinion=1)
+        Played_Song.objects.create(user_id=cls.user.profile, song_id1=s[3], opinion=2)
+        pairs = [(s[0], s[1], 0.5), (s[0], s[2], 0.25), (s[0], s[3], 0.75), (s[0], s[4], 0.375),
+                 (s[1], s[2], 0.125)]
+        for song_1, song_2, distance in pairs:
+            Distance.objects.create(song_1=song_1, song_2=song_2, distance=distance, distance_Type='W2V')
+            if not cls.symmetric:
+                Distance.objects.create(song_1=song_2, song_2=song_1, distance=distance, distance_Type='W2V')
+        # a similarity of another distance type which must not be added
+        Distance.objects.create(song_1=s[0], song_2=s[5], distance=1, distance_Type='PCA_MEL')
+        if not cls.symmetric:
+            Distance.objects.create(song_1=s[5], song_2=s[0], distance=1, distance_Type='PCA_MEL')
+
+        cls.list = List.objects.create(name='list', user_id=cls.user)
+        Song_in_List.objects.create(list_id=cls.list, song_id=s[1])
+        Song_in_List.objects.create(list_id=cls.list, song_id=s[2])
+        cls.other_list = List.objects.create(name='other list', user_id=cls.user)
+        Song_in_List.objects.create(list_id=cls.other_list, song_id=s[5])
+
+    def setUp(self):
+        storage_patch = mock.patch('songRecommender.Logic.distance_sql.SYMMETRIC_DISTANCE_STORAGE', self.symmetric)
+        storage_patch.start()
+        self.addCleanup(storage_patch.stop)
+
+    def ids(self, distances):
+        """:returns the dictionary distances with the indexes of self.songs replaced by the ids of the songs"""
+        return {self.songs[i].pk: distance for i, distance in distances.items()}
+
+    def user_distances(self, user):
+        return dict(Distance_to_User.objects.filter(user_id=user.pk, distance_Type='W2V').values_list(
+            'song_id_id', 'distance'))
+
+    def list_distances(self, song_list):
+        return dict(Distance_to_List.objects.filter(list_id=song_list, distance_Type='W2V').values_list(
+            'song_id_id', 'distance'))
+
+    def test_distances_to_user_inserted_with_opinion_weights(self):
+        changed = upsert_distances_to_user([self.songs[0].pk], self.user.pk, 'W2V')
+        expected = self.ids({1: 0.5 * 2, 2: 0.25, 3: 0.75 * 3, 4: 0.375})
+        self.assertEqual(self.user_distances(self.user), expected)
+        self.assertEqual(dict(changed), expected)
+
+    def test_distances_to_user_increased(self):
+        upsert_distances_to_user([self.songs[0].pk], self.user.pk, 'W2V')
+        changed = upsert_distances_to_user([self.songs[0].pk, self.songs[1].pk], self.user.pk, 'W2V')
+        expected = self.ids({0: 0.5, 1: 2 * 1.0, 2: 2 * 0.25 + 0.125, 3: 2 * 2.25, 4: 2 * 0.375})
+        self.assertEqual(self.user_distances(self.user), expected)
+        self.assertEqual(dict(changed), expected)
+
+    def test_duplicate_song_ids_added_twice(self):
+        upsert_distances_to_user([self.songs[0].pk, self.songs[0].pk], self.user.pk, 'W2V')
+        self.assertEqual(self.user_distances(self.user), self.ids({1: 2.0, 2: 0.5, 3: 4.5, 4: 0.75}))
+
+    def test_distances_to_users_weighted_by_each_user(self):
+        changed = upsert_distances_to_users([self.songs[0].pk], [self.user.pk, self.other_user.pk], 'W2V')
+        self.assertEqual(self.user_distances(self.user), self.ids({1: 1.0, 2: 0.25, 3: 2.25, 4: 0.375}))
+        self.assertEqual(self.user_distances(self.other_user), self.ids({1: 0.5, 2: 0.25, 3: 0.75, 4: 0.375}))
+        self.assertEqual(len(changed), 8)
+        self.assertIn((self.other_user.pk, self.songs[3].pk, 0.75), changed)
+
+    def test_distances_to_list(self):
+        count = upsert_distances_to_list([self.songs[1].pk, self.songs[2].pk], self.list.pk, 'W2V')
+        # the neighbours of song 1 are songs 0 and 2, the neighbours of song 2 are songs 0 and 1
+        expected = self.ids({0: 0.5 + 0.25, 1: 0.125 * 2, 2: 0.125})
+        self.assertEqual(count, 3)
+        self.assertEqual(self.list_distances(self.list), expected)
+
+        upsert_distances_to_list([self.songs[2].pk], self.list.pk, 'W2V')
+        expected = self.ids({0: 0.75 + 0.25, 1: 0.25 + 0.25, 2: 0.125})
+        self.assertEqual(self.list_distances(self.list), expected)
+
+    def test_added_song_distances_to_lists_replaced(self):
+        Distance_to_List.objects.create(list_id=self.list, song_id=self.songs[0], distance=8, distance_Type='W2V')
+        count = upsert_added_song_distances_to_lists(self.songs[0].pk, self.user.pk, 'W2V')
+        self.assertEqual(count, 1)
+        self.assertEqual(self.list_distances(self.list), self.ids({0: 0.5 + 0.25}))
+        # the other list has no song similar to the added song
+        self.assertEqual(self.list_distances(self.other_list), {})
+
+    def test_merge_top_recommendations(self):
+        self.assertEqual(get_top_recommendations(self.user.pk, 'W2V'), [])
+        changed = upsert_distances_to_user([self.songs[0].pk], self.user.pk, 'W2V')
+        merge_top_recommendations(self.user.pk, 'W2V', changed)
+        # the played songs 1 and 3 are not recommended
+        self.assertEqual(get_top_recommendations(self.user.pk, 'W2V'),
+                         [(self.songs[4].pk, 0.375), (self.songs[2].pk, 0.25)])
+
+        changed = upsert_distances_to_user([self.songs[1].pk], self.user.pk, 'W2V')
+        merge_top_recommendations(self.user.pk, 'W2V', changed)
+        top = User_Top_Recommendations.objects.get(user_id=self.user, distance_Type='W2V')
+        self.assertFalse(top.refill)
+        self.assertEqual(top.song_ids[0], self.songs[0].pk)
+        self.assertEqual(dict(zip(top.song_ids, top.distances)), self.ids({0: 0.5, 2: 0.375, 4: 0.375}))
+
+
+class SymmetricDistanceUpsertTests(DistanceUpsertTests):
+    """runs the tests of DistanceUpsertTests with each pair of songs stored once, with song_1 < song_2"""
+    symmetric = True
@@ -5,15 +5,20 @@ from django.urls import reverse, reverse_lazy
 from django.views.generic.edit import CreateView, UpdateView, DeleteView
 from django.template.loader import render_to_string
 from django.views.generic.list import MultipleObjectMixin
+from django.db.models import Prefetch
 
-from songRecommender.data.load_distances import load_songs_to_database, load_all_representations, load_all_distances
 from songRecommender.forms import SongModelForm, ListModelForm
-from songRecommender.models import Song, List, Song_in_List, Played_Song, Distance_to_User, Distance, Distance_to_List
-from songRecommender_project.tasks import handle_added_song, recalculate_distanced_when_new_song_added, recalculate_all_distances_to_user, recalculate_all_distances_to_list, recalculate_distances_for_relevant_lists
+from songRecommender.models import Song, List, Song_in_List, Played_Song, Distance_to_User, Distance, Distance_to_List, \
+    SONG_DISPLAY_FIELDS, song_display_fields
+from songRecommender_project.tasks import handle_added_song, schedule_recalculation
 from songRecommender.Logic.Recommender import check_if_in_played
+from songRecommender.Logic.recommendation_cache import get_recommendations
+from songRecommender.Logic.song_search import search_songs
+from songRecommender.Logic.distance_sql import nearby_songs_of_users_lists
 from songRecommender_project.settings import EMAIL_DISABLED
 from .forms import SignUpForm
 from .tokens import account_activation_token
+from .pagination import KeysetPaginationMixin
 
 from django.contrib.sites.shortcuts import get_current_site
 from django.contrib.auth import login
@@ -21,8 +26,6 @@ from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 
-from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
-
 from django.utils.encoding import force_text, force_bytes
 from django.utils.http import urlsafe_base64_decode, urlsafe_base64_encode
 from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
@@ -49,18 +52,14 @@ class HomePageView(LoginRequiredMixin, generic.ListView):
     template_name = 'songRecommender/index.html'
 
     def get_queryset(self):
-        """:returns all songs the user has not played yet but with respect
-        to their distance to the user """
-        played_songs = Played_Song.objects.all().filter(user_id=self.request.user.profile.pk)
-        return Distance_to_User.objects.all().filter(
-            distance_Type=self.request.user.profile.user_selected_distance_type,
-            user_id=self.request.user.pk).exclude(
-            song_id_id__in=played_songs.values_list('song_id1_id', flat=True)).order_by('-distance')
+        """:returns the songs the user has not played yet which are the most similar
+        to the user, from the recommendation cache """
+        return get_recommendations(self.request.user.pk, self.request.user.profile.user_selected_distance_type, 10)
 
     def get_context_data(self, **kwargs):
         """:returns the queryset with the current users lists included"""
         context = super(HomePageView, self).get_context_data(**kwargs)
-        context['my_lists'] = List.objects.filter(user_id=self.request.user)
+        context['my_lists'] = List.objects.filter(user_id=self.request.user).only('id', 'name')
         return context
 
 
@@ -80,6 +79,10 @@ class SongDetailView(LoginRequiredMixin, generic.DetailView):
     template_name = 'songRecommender/song_detail.html'
     paginate_by = 10
 
+    def get_queryset(self):
+        """:returns the songs with only the fields shown on the page"""
+        return Song.objects.only(*SONG_DISPLAY_FIELDS, 'audio', 'link_on_disc')
+
     def get_context_data(self, *, object_list=None, **kwargs):
         """function that returns the context for the html page,
         has the same parameters as base function
@@ -91,34 +94,25 @@ class SongDetailView(LoginRequiredMixin, generic.DetailView):
         is also the played song corresponding to the song from the detail view and
         all the lists created by the current user
 
-        There is the possibility to store data inside the database when uncommenting the designated lines inside
-        of this function
+        The songs, their representations and distances are loaded into the database with
+        "python manage.py import_dataset"
         """
-        #### section to be run when loaded data into the database #####
-
-        # NOTE!!! It is necessary to have the songs loaded inside the dabase using "load_songs_to_database()" BEFORE
-        # loading the representations and distances
-
-        # For loading uncomment the next three lines:
-        # load_songs_to_database()
-        # load_all_representations()
-        # load_all_distances()
         context = super(SongDetailView, self).get_context_data(**kwargs)
         check_if_in_played(context['object'].pk, self.request.user, is_being_played=True)
 
         played_songs = Played_Song.objects.filter(user_id=self.request.user.profile.pk).values_list('song_id1_id')
         context['played_song'] = Played_Song.objects.filter(
-            song_id1=context['object'], user_id=self.request.user.profile).only('song_id1')
-        context['my_lists'] = List.objects.filter(user_id=self.request.user)
+            song_id1=context['object'], user_id=self.request.user.profile).only('id', 'opinion')
+        context['my_lists'] = List.objects.filter(user_id=self.request.user).only('id', 'name')
         #POZOR!!! Napraseni kod, co ale funguje, mozna potom prejmenovat, vraci se distance ale pouziva song
-        context['nearby_songs'] = Distance.objects.filter(
-            distance_Type=self.request.user.profile.user_selected_distance_type, song_2=context['object']).exclude(
-            song_1_id__in=played_songs).order_by('-distance')[:10]
+        context['nearby_songs'] = Distance.objects.neighbours(
+            context['object'].pk, self.request.user.profile.user_selected_distance_type,
+            exclude_song_ids=played_songs, count=10)
         context['link'] = context['object'].link_on_disc
         return context
 
 
-class ListDetailView(LoginRequiredMixin, generic.DetailView, MultipleObjectMixin):
+class ListDetailView(LoginRequiredMixin, KeysetPaginationMixin, generic.DetailView, MultipleObjectMixin):
     """class generating a detail view for a particular list
 
     Overridden Methods
@@ -136,16 +130,17 @@ class ListDetailView(LoginRequiredMixin, generic.DetailView, MultipleObjectMixin
         return List.objects.filter(user_id=self.request.user)
 
     def get_context_data(self, *, object_list=None, **kwargs):
-        songs = Song_in_List.objects.filter(list_id=self.get_object().pk)
+        songs = Song_in_List.objects.filter(list_id=self.object.pk).select_related('song_id').only(
+            'id', 'song_id', *song_display_fields('song_id'))
         context = super(ListDetailView, self).get_context_data(object_list=songs, **kwargs)
         played_songs = Played_Song.objects.filter(user_id=self.request.user.profile.pk)
         context['songs'] = songs
+        # the songs in the list are always played, so they are not among the nearby songs
         context['nearby_songs'] = Distance_to_List.objects.filter(
             distance_Type=self.request.user.profile.user_selected_distance_type,
             list_id=context['object'].pk).exclude(
-            song_id_id__in=played_songs.values_list('song_id1_id', flat=True)).order_by('-distance')[:10]
-        context['start_page'] = context['page_obj'].number - 3
-        context['end_page'] = context['page_obj'].number + 3
+            song_id_id__in=played_songs.values_list('song_id1_id', flat=True)).select_related('song_id').only(
+            'id', 'song_id', *song_display_fields('song_id')).order_by('-distance')[:10]
         return context
 
 class ListCreate(LoginRequiredMixin, CreateView):
@@ -212,22 +207,27 @@ class MyListsView(LoginRequiredMixin, generic.ListView):
 
 
     def get_queryset(self):
-        return List.objects.filter(user_id=self.request.user.pk)
+        # the 10 songs nearby each list are read for all the lists by one query
+        nearby_songs = Distance_to_List.objects.filter(
+            id__in=nearby_songs_of_users_lists(self.request.user.pk, 10)).select_related('song_id').only(
+            'id', 'list_id', 'song_id', *song_display_fields('song_id'))
+        return List.objects.filter(user_id=self.request.user.pk).only('id', 'name', 'user_id').prefetch_related(
+            Prefetch('songs', queryset=Song.objects.only(*SONG_DISPLAY_FIELDS)),
+            Prefetch('distance_to_list_set', queryset=nearby_songs, to_attr='shown_nearby_songs'))
 
     def get_context_data(self, *, object_list=None, **kwargs):
         context = super(MyListsView, self).get_context_data(**kwargs)
         played_songs = Played_Song.objects.filter(user_id=self.request.user.profile.pk)
-        context['played_songs'] = played_songs.exclude(opinion=-1)
+        context['played_songs'] = played_songs.exclude(opinion=-1).select_related('song_id1').only(
+            'id', 'song_id1', *song_display_fields('song_id1'))
         #!!! POZOR napraseny kod, vracime Distance to user ale pouziva se song
-        context['recommended_songs'] = Distance_to_User.objects.all().filter(
-            distance_Type=self.request.user.profile.user_selected_distance_type,
-            user_id=self.request.user.pk).exclude(
-            song_id_id__in=played_songs.values_list('song_id1_id', flat=True).order_by('-distance'))[:10]
+        context['recommended_songs'] = get_recommendations(
+            self.request.user.pk, self.request.user.profile.user_selected_distance_type, 10)
 
         return context
 
 
-class AllSongsView(LoginRequiredMixin, generic.ListView):
+class AllSongsView(LoginRequiredMixin, KeysetPaginationMixin, generic.ListView):
     """ class based django view that shows all songs stored in the database
     in a not specified order to every user in the same way
     the only difference is that every user can add those songs to only his own list
@@ -252,14 +252,12 @@ class AllSongsView(LoginRequiredMixin, generic.ListView):
         to the current user"""
 
         context = super(AllSongsView, self).get_context_data(**kwargs)
-        context['my_lists'] = List.objects.filter(user_id=self.request.user)
-        context['start_page'] = context['page_obj'].number - 3
-        context['end_page'] = context['page_obj'].number + 3
+        context['my_lists'] = List.objects.filter(user_id=self.request.user).only('id', 'name')
 
         return context
 
 
-class RecommendedSongsView(LoginRequiredMixin, generic.ListView):
+class RecommendedSongsView(LoginRequiredMixin, KeysetPaginationMixin, generic.ListView):
     """
     class used for the recommended songs page
     displays songs the user played and did not dislike and the songs that are
@@ -282,11 +280,13 @@ class RecommendedSongsView(LoginRequiredMixin, generic.ListView):
     template_name = 'songRecommender/recommended_songs.html'
     context_object_name = 'played_songs'
     paginate_by = 10
+    page_window = 4
 
     def get_queryset(self):
         """:returns only the songs recommended to the user that he did not played
         before from the table distance_to_user"""
-        return Played_Song.objects.filter(user_id_id=self.request.user.profile.pk)
+        return Played_Song.objects.filter(user_id_id=self.request.user.profile.pk).select_related('song_id1').only(
+            'id', 'song_id1', *song_display_fields('song_id1'))
 
     def get_context_data(self, *, object_list=None, **kwargs):
         """
@@ -295,15 +295,8 @@ class RecommendedSongsView(LoginRequiredMixin, generic.ListView):
         view
         """
         context = super(RecommendedSongsView, self).get_context_data(**kwargs)
-        played_songs = Played_Song.objects.filter(
-            user_id=self.request.user.profile.pk)
-        context['nearby_songs'] = (Distance_to_User.objects.all().filter(
-            distance_Type=self.request.user.profile.user_selected_distance_type,
-            user_id=self.request.user.pk).exclude(
-            song_id_id__in=played_songs.values_list('song_id1_id', flat=True)).order_by('-distance'))[:10]
-
-        context['start_page'] = context['page_obj'].number - 4
-        context['end_page'] = context['page_obj'].number + 4
+        context['nearby_songs'] = get_recommendations(
+            self.request.user.pk, self.request.user.profile.user_selected_distance_type, 10)
 
         return context
 
@@ -328,10 +321,11 @@ def likeSong(request, pk):
         played_song.opinion = 0
     played_song.save()
 
-    # recalculates the distance of all songs to the user and his lists based
+    # recalculates the distance of all songs to the user and his lists based,
+    # the recalculations of quick successive clicks are applied together
     user_id = int(request.user.id)
-    recalculate_all_distances_to_user.delay(pk, user_id)
-    recalculate_distances_for_relevant_lists.delay(pk, user_id)
+    schedule_recalculation(pk, user_id, 'USER')
+    schedule_recalculation(pk, user_id, 'LISTS')
 
     return redirect('song_detail', request.path.split('/')[2])
 
@@ -357,7 +351,7 @@ def dislikeSong(request, pk):
 
     # recalculates the distances of all songs to the user and all his lists
     user_id = request.user.pk
-    recalculate_all_distances_to_user.delay(pk, user_id)
+    schedule_recalculation(pk, user_id, 'USER')
 
     return redirect('song_detail', request.path.split('/')[2])
 
@@ -387,8 +381,8 @@ def addSong(request):
                 if created:
                     played_song.save()
 
+                # the similarities to the users and their lists are calculated after those to the other songs
                 handle_added_song.delay(song.pk)
-                recalculate_distanced_when_new_song_added.delay(song.pk)
 
 
                 # redirects the user to his recommended songs
@@ -485,7 +479,7 @@ def add_song_to_list(request, pk, pk2):
         song_in_list.save()
 
         check_if_in_played(pk, request.user, is_being_played=False)
-        recalculate_all_distances_to_list.delay(pk, pk2)
+        schedule_recalculation(pk, request.user.pk, 'LIST', list_id=pk2)
 
         return redirect('song_detail', pk)
 
@@ -507,20 +501,17 @@ def logout(request):
 
 @login_required()
 def search(request):
-    """implements the search, shows ten best results if there
-    are ten with a rank higher than 0, which means, if there
-    are ten that are at least somewhat similar
+    """implements the search, shows ten best results, first the songs
+    found by the indexed full text search and then the songs whose name
+    or artist is similar to the query, so also queries with a typo find songs
 
     redirects to a search_results page with songs that were found
     the user can each song to a any of his lists"""
 
-    vector = SearchVector('artist', 'song_name')
-    my_lists = List.objects.all().filter(user_id=request.user)
+    my_lists = List.objects.all().filter(user_id=request.user).only('id', 'name')
     if 'q' in request.GET and request.GET['q']:
         q = request.GET['q']
-        query = SearchQuery(q)
-
-        entries = Song.objects.annotate(rank=SearchRank(vector, query)).order_by('-rank').exclude(rank=0)[:10]
+        entries = search_songs(q, 10)
 
 
         return render(request, 'songRecommender/search_results.html', {'entries': entries, 'query': q, 'my_lists': my_lists})
@@ -1,6 +1,9 @@
 from __future__ import absolute_import, unicode_literals
 import os
 from celery import Celery
+from celery.signals import celeryd_after_setup, worker_process_init, worker_ready
+
+from songRecommender_project.settings import WARM_UP_MODELS
 
 # set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'songRecommender_project.settings')
@@ -23,6 +26,26 @@ app.conf.update(
 app.autodiscover_tasks()
 
 
+# a worker started with WARM_UP_MODELS=1 loads the models computing the song representations when it starts
+# instead of when the first song is added. With the prefork pool only the child processes which run the tasks
+# load them, the parent process would hold a second copy and fork the later children with a live tensorflow
+# session, with the solo and gevent pools the tasks run in the worker process itself
+def warm_up(**kwargs):
+    from songRecommender.Logic.model_registry import warm_up_models
+    warm_up_models()
+
+
+@celeryd_after_setup.connect
+def connect_warm_up(sender, instance, **kwargs):
+    if not WARM_UP_MODELS:
+        return
+    pool = instance.pool_cls if isinstance(instance.pool_cls, str) else instance.pool_cls.__module__
+    if 'prefork' in pool:
+        worker_process_init.connect(warm_up, weak=False)
+    else:
+        worker_ready.connect(warm_up, weak=False)
+
+
 #@app.task(bind=True)
 #def debug_task(self):
 #    print('Request: {0!r}'.format(self.request))
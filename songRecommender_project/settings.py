@@ -11,13 +11,6 @@ https://docs.djangoproject.com/en/2.0/ref/settings/
 """
 
 import os
-from keras.models import load_model
-from keras.models import model_from_json
-
-import tensorflow as tf
-
-import joblib, pickle
-from gensim.models.keyedvectors import KeyedVectors
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -43,6 +36,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
 ]
 
 MIDDLEWARE = [
@@ -84,6 +78,12 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'songRecommender_project.wsgi.application'
 MP3FILES_DIR = os.path.join(BASE_DIR, 'mp3_files/')
+# directory with the memory-mapped song representations, see songRecommender/Logic/memmap_representations.py
+MEMMAP_REPRESENTATIONS_DIR = os.path.join(BASE_DIR, 'songRecommender_project/representations/memmap/')
+# directory with the cached audio features of the mp3 files, see songRecommender/Logic/feature_cache.py
+FEATURE_CACHE_DIR = os.path.join(BASE_DIR, 'feature_cache/')
+# the maximal size of the feature cache in bytes, the least recently used features are deleted above it
+FEATURE_CACHE_MAX_SIZE = 2 * 1024 ** 3
 MEDIA_ROOT = os.path.join(BASE_DIR, "mp3_files")
 MEDIA_URL = '/song/'
 
@@ -143,13 +143,61 @@ LOGIN_REDIRECT_URL = '/songRecommender/index'
 EMAIL_DISABLED = True
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
+# Cache configuration, the file based cache is shared by the web server and the celery workers,
+# the songs recommended to each user are cached there
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', os.path.join(BASE_DIR, 'cache')),
+    }
+}
+# the number of songs kept in the top recommendations of each user and distance type
+TOP_RECOMMENDATIONS_SIZE = 100
+# the number of seconds the recommended songs of a user stay in the cache
+RECOMMENDATION_CACHE_TIMEOUT = 24 * 60 * 60
+
 # Celery configuration
 CELERY_BROKER_URL = 'amqp://localhost'
 BROKER_POOL_LIMIT = None
+# the representations of the added songs are computed by a separate worker consuming the feature_extraction queue
+CELERY_TASK_ROUTES = {
+    'songRecommender_project.tasks.extract_pending_features': {'queue': 'feature_extraction'},
+}
+
+# the number of seconds the added songs are collected before their representations are computed at once
+FEATURE_EXTRACTION_BATCH_SECONDS = 10
+# the maximal number of added songs whose representations are computed by one batch of predictions
+FEATURE_EXTRACTION_BATCH_SIZE = 32
+
+# the number of seconds the recalculations of a user's similarities are collected before they are applied at once
+RECALCULATION_DEBOUNCE_SECONDS = 5
+
+# the number of users whose similarities to a newly added song are calculated by one task
+NEW_SONG_FANOUT_CHUNK_SIZE = 500
+
+# if True the lists of songs are paged by keyset pagination (previous and next page links), otherwise
+# by numbered pages, which have to count the songs and skip the songs of the previous pages
+KEYSET_PAGINATION = True
 
 # Default distance type configuration
 SELECTED_DISTANCE_TYPE = "GRU_MEL"
 
+# Nearest neighbour index used to find the songs similar to an added song, 'exact' or the approximate 'ivf'
+NEAREST_NEIGHBOUR_INDEX = 'exact'
+# the number of representations multiplied at once when searching for neighbours
+NEAREST_NEIGHBOUR_BLOCK_SIZE = 4096
+# the maximal number of neighbours saved for an added song, None saves all above the threshold
+NEAREST_NEIGHBOURS_K = None
+# the number of clusters of the ivf index and the number of them searched through for each query
+IVF_N_LISTS = 128
+IVF_N_PROBE = 8
+
+# the number of Distance rows inserted by one bulk insert
+DISTANCE_BATCH_SIZE = 5000
+# if True each pair of songs is stored in the Distance table only once (with song_1 < song_2) instead of
+# in both directions, the existing distances have to be imported again after changing it
+SYMMETRIC_DISTANCE_STORAGE = False
+
 # Distance thresholds for 51x16594 distances
 PCA_TF_IDF_THRESHOLD = 0.1799
 W2V_THRESHOLD = 0.9467
@@ -159,30 +207,16 @@ LSTM_MFCC_THRESHOLD = 0.99786
 
 print("base dir path", BASE_DIR)
 
-# Loading models
-json_file = open('songRecommender_project/models/GRU_Mel_model.json', 'r')
-loaded_model_json = json_file.read()
-json_file.close()
-GRU_Mel_model = model_from_json(loaded_model_json)
-# load weights into new model
-GRU_Mel_model.load_weights("songRecommender_project/models/GRU_Mel_model.h5")
-GRU_Mel_graph = tf.get_default_graph()
-print("gru_mel model loaded from disk")
-
-PCA_Mel_model = joblib.load('songRecommender_project/models/mel_pca_model_joblib')
-print('pca mel model loaded')
-
-W2V_model = KeyedVectors.load('songRecommender_project/models/w2v_subset', mmap='r')
-print('w2v model loaded')
-
-TF_idf_model = pickle.load(open('songRecommender_project/models/tfidf_model', "rb"))
-
-PCA_Tf_idf_model = joblib.load('songRecommender_project/models/pca_tf_idf_model_90_ratio')
-print('tf_idf model loaded')
-
-LSTM_MFCC_model = load_model('songRecommender_project/models/LSTM_MFCC_model.h5')
-LSTM_MFCC_graph = tf.get_default_graph()
-print('mfcc model loaded')
+# The models computing the representations of added songs, they are loaded when they are used for the first
+# time by songRecommender/Logic/model_registry.py, the workers started with WARM_UP_MODELS=1 load them at start
+GRU_MEL_MODEL_JSON_PATH = 'songRecommender_project/models/GRU_Mel_model.json'
+GRU_MEL_MODEL_WEIGHTS_PATH = 'songRecommender_project/models/GRU_Mel_model.h5'
+LSTM_MFCC_MODEL_PATH = 'songRecommender_project/models/LSTM_MFCC_model.h5'
+PCA_MEL_MODEL_PATH = 'songRecommender_project/models/mel_pca_model_joblib'
+W2V_MODEL_PATH = 'songRecommender_project/models/w2v_subset'
+TF_IDF_MODEL_PATH = 'songRecommender_project/models/tfidf_model'
+PCA_TF_IDF_MODEL_PATH = 'songRecommender_project/models/pca_tf_idf_model_90_ratio'
+WARM_UP_MODELS = os.getenv('WARM_UP_MODELS', '0') == '1'
 
 # Spectrogram settings !!!! DO NOT CHANGE !!!
 n_fft = 4410
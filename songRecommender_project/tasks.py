@@ -3,15 +3,51 @@ from celery import Celery
 from celery import shared_task
 
 from songRecommender.models import Song, List, Distance, Distance_to_List, Distance_to_User, Song_in_List,\
-    Profile, Played_Song
+    Profile, Played_Song, Pending_Recalculation, Pending_Feature_Extraction, SONG_REPRESENTATION_FIELDS
 import sklearn, numpy
+from django.db import transaction, connection
 from django.db.models import Sum
-from songRecommender.Logic.adding_songs import save_all_representations
+from songRecommender.Logic.adding_songs import save_representations_of_songs
+from songRecommender.Logic.embedding_store import add_song_to_embedding_stores, get_embedding_store, \
+    sync_embedding_stores
+from songRecommender.Logic.nearest_neighbours import get_nearest_neighbour_index
+from songRecommender.Logic.distance_writer import bulk_save_distances
+from songRecommender.Logic.recommendation_cache import invalidate_recommendations
+from songRecommender.Logic.top_recommendations import merge_top_recommendations, delete_top_recommendations
+from songRecommender.Logic.distance_sql import upsert_distances_to_user, upsert_distances_to_list, \
+    upsert_added_song_distances_to_lists, upsert_distances_to_users, upsert_added_song_distances_to_users_lists
 
 from songRecommender_project.settings import PCA_TF_IDF_THRESHOLD, W2V_THRESHOLD, LSTM_MFCC_THRESHOLD, PCA_MEL_THRESHOLD, GRU_MEL_THRESHOLD
+from songRecommender_project.settings import NEAREST_NEIGHBOURS_K, RECALCULATION_DEBOUNCE_SECONDS, \
+    NEW_SONG_FANOUT_CHUNK_SIZE, FEATURE_EXTRACTION_BATCH_SECONDS, FEATURE_EXTRACTION_BATCH_SIZE
 
 app = Celery('tasks', broker='amqp://localhost')
 
+THRESHOLDS = {
+    'PCA_TF-idf': PCA_TF_IDF_THRESHOLD,
+    'W2V': W2V_THRESHOLD,
+    'PCA_MEL': PCA_MEL_THRESHOLD,
+    'GRU_MEL': GRU_MEL_THRESHOLD,
+    'LSTM_MFCC': LSTM_MFCC_THRESHOLD,
+}
+
+
+# the namespaces of the advisory locks serializing the writers of the pending tables
+RECALCULATION_LOCK = 1
+FEATURE_EXTRACTION_LOCK = 2
+
+
+def lock_pending(namespace, key):
+    """
+    takes a postgres advisory lock held until the end of the current transaction, so checking whether a flush
+    has to be enqueued and the flush deleting the pending rows it applied cannot interleave
+    :param namespace: the namespace of the lock, e.g. RECALCULATION_LOCK
+    :param key: the key of the lock in the namespace, e.g. the id of the user
+    :return: None
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_xact_lock(%s, %s)', [namespace, key])
+
 
 @shared_task
 def add(x, y):
@@ -22,19 +58,13 @@ def calculate_distance_of_added_song_to_lists(song_id, user_id, distance_Type):
     """
     calculates the similarity (which kind is specified by the distance_Type) of a newly added song specified by
     song_id to the lists of the user specified by user_id and save the new Distance_to_List instances into the database.
+    All the lists of the user are updated by a single upsert statement.
     :param song_id: the id of the song of which the similarity to the users lists is calculated
     :param user_id: the user whose lists similarity to the song is calculated
     :param distance_Type: the distance Type of which the calculated similarities are
     :return: None, just saves the Distance_to_List objects to the database
     """
-    relevant_songs = Distance.objects.filter(song_1_id=song_id, song_2__song_in_list__list_id__user_id=user_id, distance_Type=distance_Type).values('id')
-    relevant_lists = List.objects.filter(user_id_id=user_id, song_in_list__song_id_id__in=relevant_songs)
-
-    for list in relevant_lists:
-        songs_in_list = Song_in_List.objects.filter(list_id=list, song_id_id__in=relevant_songs)
-        distance = Distance.objects.filter(song_2__song_in_list__in=songs_in_list, song_1_id=song_id, distance_Type=distance_Type).aggregate(total=Sum('distance'))['total']
-        list_distance = Distance_to_List.objects.create(song_id_id=song_id, list_id=list, distance_Type=distance_Type, distance=distance)
-        list_distance.save()
+    upsert_added_song_distances_to_lists(song_id, user_id, distance_Type)
 
 
 @shared_task
@@ -52,59 +82,26 @@ def recalculate_distances_for_relevant_lists(song_id, user_id):
 
 @shared_task
 def recalculate_distances_to_user(song_id, cur_user_id, distance_type):
-    """for every song in the database it recalculates
-    the distance to every user and the distance to every list
-    the current user has created"""
-
-    relevant_song_ids = Distance.objects.filter(song_1_id=song_id, distance_Type=distance_type).values('song_2_id', 'distance')
-
-    for s in relevant_song_ids:
-        user_distance, created = Distance_to_User.objects.get_or_create(user_id_id=cur_user_id, song_id_id=s['song_2_id'], distance_Type=distance_type)
-        try:
-            played_song = Played_Song.objects.get(song_id1_id=s['song_2_id'])
-            if created:
-                user_distance.distance = (played_song.opinion + 1) * s['distance']
-            else:
-                user_distance.distance = (user_distance.distance + (played_song.opinion + 1) * s['distance'])
-            user_distance.save()
-        except:
-
-            if created:
-                user_distance.distance = s['distance']
-            else:
-                user_distance.distance = user_distance.distance + s['distance']
-            user_distance.save()
+    """adds the similarities of the song specified by song_id to its neighbours
+    to the distances of the neighbours to the current user, weighted by the user's opinion
+    of each neighbour, with a single upsert statement, the changed similarities are merged
+    into the user's top recommendations"""
+
+    changed = upsert_distances_to_user([song_id], cur_user_id, distance_type)
+    merge_top_recommendations(cur_user_id, distance_type, changed)
+    invalidate_recommendations([cur_user_id])
 
 
 def recalculate_distances_to_list(song_id, list_id, distance_type):
     """
     recalculates the similarity (what kind is specified with distance_type) of the song
-     specified by song_id to the list specified by list_id
+     specified by song_id to the list specified by list_id with a single upsert statement
     :param song_id: the song's id to which the similarity is recalculated
     :param list_id: the list's id to which the similarity is recalculated
     :param distance_type: specifies the type of similarity that is being recalculated
     :return: None
     """
-    relevant_song_ids = Distance.objects.filter(song_1_id=song_id, distance_Type=distance_type).values('song_2_id', 'distance')
-
-    for s in relevant_song_ids:
-        list_distance, created = Distance_to_List.objects.get_or_create(list_id_id=list_id, song_id_id=s['song_2_id'],
-                                                                        distance_Type=distance_type)
-        try:
-            played_song = Played_Song.objects.get(song_id1_id=s['song_2_id'])
-            if created:
-                list_distance.distance = (played_song.opinion + 1) * s['distance']
-            else:
-                list_distance.distance = (list_distance.distance + (played_song.opinion + 1) * s['distance'])
-            list_distance.save()
-
-        except:
-            if created:
-                list_distance.distance = s['distance']
-            else:
-                list_distance.distance = (list_distance.distance + s['distance'])
-            list_distance.save()
-
+    upsert_distances_to_list([song_id], list_id, distance_type)
 
 
 @shared_task
@@ -153,245 +150,275 @@ def recalculate_all_distances_to_list(song_id, list_id):
     recalculate_distances_to_list(song_id, list_id, 'LSTM_MFCC')
 
 
+def schedule_recalculation(song_id, user_id, recalculation_type, list_id=None):
+    """
+    records that the similarities of the song specified by song_id to the user specified by user_id (recalculation_type
+    'USER'), to all his lists ('LISTS') or to the list specified by list_id ('LIST') have to be recalculated.
+    The recalculations of a user are collected for RECALCULATION_DEBOUNCE_SECONDS and then applied at once
+    by flush_pending_recalculations, which is only enqueued by the first recalculation of the window
+    :param song_id: the id of the song whose similarities are recalculated
+    :param user_id: the id of the user
+    :param recalculation_type: one of Pending_Recalculation.RECALCULATION_CHOICES
+    :param list_id: the id of the list for the 'LIST' recalculation type
+    :return: None
+    """
+    with transaction.atomic():
+        # a flush taking the pending rows at the same time either takes them before the check, so the row starts
+        # a new window, or after the row is committed, so it applies it
+        lock_pending(RECALCULATION_LOCK, user_id)
+        first = not Pending_Recalculation.objects.filter(user_id_id=user_id).exists()
+        Pending_Recalculation.objects.create(user_id_id=user_id, song_id_id=song_id, list_id_id=list_id,
+                                             recalculation_Type=recalculation_type)
+    if first:
+        flush_pending_recalculations.apply_async((user_id,), countdown=RECALCULATION_DEBOUNCE_SECONDS)
+
+
+@shared_task
+def flush_pending_recalculations(user_id):
+    """
+    applies all the pending recalculations of the user specified by user_id in one batch, each distance type
+    of the user and of each of the affected lists is updated by a single statement for all the pending songs.
+    The pending rows are taken and deleted under the user's lock by a short transaction, the recalculations are
+    applied after it, so schedule_recalculation never waits for them, a row recorded after the rows were taken
+    starts a new window with its own flush
+    :param user_id: the id of the user
+    :return: None
+    """
+    with transaction.atomic():
+        lock_pending(RECALCULATION_LOCK, user_id)
+        pending = list(Pending_Recalculation.objects.filter(user_id_id=user_id).values_list(
+            'id', 'song_id_id', 'list_id_id', 'recalculation_Type'))
+        Pending_Recalculation.objects.filter(id__in=[pending_id for pending_id, _, _, _ in pending]).delete()
+
+    user_songs = [song_id for _, song_id, _, recalculation_type in pending if recalculation_type == 'USER']
+    list_songs = {}
+    lists_songs = [song_id for _, song_id, _, recalculation_type in pending if recalculation_type == 'LISTS']
+    if lists_songs:
+        for list_id in List.objects.filter(user_id_id=user_id).values_list('id', flat=True):
+            list_songs[list_id] = list(lists_songs)
+    for _, song_id, list_id, recalculation_type in pending:
+        if recalculation_type == 'LIST':
+            list_songs.setdefault(list_id, []).append(song_id)
+
+    with transaction.atomic():
+        for distance_type in THRESHOLDS:
+            if user_songs:
+                changed = upsert_distances_to_user(user_songs, user_id, distance_type)
+                merge_top_recommendations(user_id, distance_type, changed)
+            for list_id, song_ids in list_songs.items():
+                upsert_distances_to_list(song_ids, list_id, distance_type)
+    if user_songs:
+        invalidate_recommendations([user_id])
+
+
 @shared_task()
 def handle_added_song(song_id):
     """
-    saves the representations of the added song using the implemented methods and calculates
-    all the distances of the new song to the songs that are already in the database
+    records that the representations of the added song have to be computed. The added songs are collected
+    for FEATURE_EXTRACTION_BATCH_SECONDS and then processed at once by extract_pending_features,
+    which is only enqueued by the first song of the window
     :param song_id: the id of the added song
     :return: None
     """
+    with transaction.atomic():
+        lock_pending(FEATURE_EXTRACTION_LOCK, 0)
+        first = not Pending_Feature_Extraction.objects.exists()
+        Pending_Feature_Extraction.objects.create(song_id_id=song_id)
+    if first:
+        extract_pending_features.apply_async(countdown=FEATURE_EXTRACTION_BATCH_SECONDS)
 
-    save_all_representations(song_id)
 
-    # load_w2v_representations(10000, song_id)
-    # print('w2v loaded, distances saved')
-
-    print(Song.objects.get(id=song_id).audio)
-    if Song.objects.get(id=song_id).audio:
-        load_pca_mel_representations(10000, song_id)
-        print('spec reprs loaded and distances saved')
-
-        load_gru_mel_representations(5000, song_id)
-        print('gru mel distances saved')
+@shared_task()
+def extract_pending_features(batch_size=FEATURE_EXTRACTION_BATCH_SIZE):
+    """
+    saves the representations of up to batch_size pending added songs, each model predicts the representations
+    of all the songs by a single call, and calculates all the distances of the new songs to the songs
+    that are already in the database, then the similarities of each song to the users and their lists
+    are calculated by recalculate_distanced_when_new_song_added. The task is routed to the feature_extraction
+    queue by CELERY_TASK_ROUTES. A song which fails is skipped, the rows of the batch are always deleted
+    and if more songs are pending, the next batch is enqueued right away
+    :param batch_size: the maximal number of songs processed at once
+    :return: None
+    """
+    pending = list(Pending_Feature_Extraction.objects.values_list('id', 'song_id_id')[:batch_size])
+    song_ids = list(dict.fromkeys(song_id for _, song_id in pending))
+    try:
+        if song_ids:
+            save_representations_of_songs(song_ids)
+            for song in Song.objects.with_representations().filter(id__in=song_ids):
+                try:
+                    add_song_to_embedding_stores(song)
+                    save_all_nearest_neighbours(song.pk)
+                except Exception as e:
+                    print('distances of song', song.pk, 'not saved', e)
+                else:
+                    # the fan-out reads the Distance rows of the song, so it runs only once they are saved
+                    recalculate_distanced_when_new_song_added.delay(song.pk)
+    finally:
+        with transaction.atomic():
+            lock_pending(FEATURE_EXTRACTION_LOCK, 0)
+            Pending_Feature_Extraction.objects.filter(id__in=[pending_id for pending_id, _ in pending]).delete()
+            remaining = Pending_Feature_Extraction.objects.exists()
+        if remaining:
+            extract_pending_features.delay(batch_size)
 
-        load_lstm_mfcc_representations(5000, song_id)
-        print('lstm mel distances saved')
 
-    load_pca_tf_idf_representations(7000, song_id)
-    print('tf_idf loaded, distances saved')
+@shared_task()
+def save_all_nearest_neighbours(song_id):
+    """
+    calculates and saves the similarities of the song specified by song_id to the other songs for all the
+    distance types the song has a representation of (the audio based ones only if the song has audio).
+    The embedding stores of all the distance types are synced with the database in a single pass over the Song
+    table and then each distance type costs one query of its nearest neighbour index.
+    :param song_id: the id of the song
+    :return: None
+    """
+    # load_w2v_representations(10000, song_id)
+    # print('w2v loaded, distances saved')
+    distance_types = ['PCA_TF-idf']
+    if Song.objects.filter(id=song_id, audio=True).exists():
+        distance_types = ['PCA_MEL', 'GRU_MEL', 'LSTM_MFCC'] + distance_types
 
+    sync_embedding_stores([get_embedding_store(distance_type, sync=False) for distance_type in distance_types])
+    for distance_type in distance_types:
+        save_nearest_neighbours(song_id, distance_type, THRESHOLDS[distance_type], sync=False)
+        print(distance_type, 'distances saved')
 
 
+@shared_task
+def recalculate_distanced_when_new_song_added(song_id, chunk_size=NEW_SONG_FANOUT_CHUNK_SIZE):
+    """
+    calculates the distances of the newly added song to all the users that are in the database.
+    The users are split into chunks of NEW_SONG_FANOUT_CHUNK_SIZE and one task is enqueued for each chunk
+    instead of two tasks for each user
+    :param song_id: the id of the newly added song
+    :param chunk_size: the number of users processed by one task
+    :return: None
+    """
+    user_ids = list(Profile.objects.order_by('user_id').values_list('user_id', flat=True))
+    for start in range(0, len(user_ids), chunk_size):
+        recalculate_distances_for_users.delay(song_id, user_ids[start:start + chunk_size])
 
 
 @shared_task
-def recalculate_distanced_when_new_song_added(song_id):
+def recalculate_distances_for_users(song_id, user_ids):
     """
-    calculates the distances of the newly added song to all the users that are in the database
+    recalculates all implemented similarities of the newly added song specified by song_id to the users
+    specified by user_ids and to their lists, each distance type of the users and of their lists
+    is updated by a single statement
     :param song_id: the id of the newly added song
+    :param user_ids: the ids of the users
     :return: None
     """
-    for user_id in Profile.objects.all().values_list('user_id', flat=True):
-        recalculate_all_distances_to_user.delay(song_id, user_id)
-        calculate_all_distance_of_added_song_to_lists.delay(song_id, user_id)
+    for distance_type in THRESHOLDS:
+        upsert_distances_to_users([song_id], user_ids, distance_type)
+        upsert_added_song_distances_to_users_lists(song_id, user_ids, distance_type)
+    # merging the new song into the top recommendations of every user of the chunk would cost several queries
+    # per user, so they are deleted with one statement and computed again when they are read
+    delete_top_recommendations(user_ids)
+    invalidate_recommendations(user_ids)
+
+def save_nearest_neighbours(s_id, distance_type, threshold, block_size=None, sync=True):
+    """
+    finds the songs whose similarity to the song specified by s_id is bigger than the threshold with a single
+    query of the nearest neighbour index of the distance_type and saves the similarities
+    :param s_id: the id of the song to which all the similarities are calculated to
+    :param distance_type: the distance type whose representations are used
+    :param threshold: (float32) the threshold for the particular distance type
+    :param block_size: the number of songs whose similarities are calculated at once, the default of the index if None
+    :param sync: if False the embedding store is expected to be already synced with the database
+    :return: None
+    """
+    index = get_nearest_neighbour_index(distance_type, sync)
+    if s_id in index.store:
+        representation = index.store.get(s_id)
+    else:
+        # the songs without audio are not in the embedding stores, their representation is read from the database
+        representation = Song.objects.with_representations(distance_type).filter(id=s_id).values_list(
+            SONG_REPRESENTATION_FIELDS[distance_type], flat=True).first()
+    if representation is None:
+        print('song', s_id, 'has no', distance_type, 'representation')
+        return
+
+    neighbours = index.query(representation, k=NEAREST_NEIGHBOURS_K, threshold=threshold,
+                             block_size=block_size, exclude=s_id)
+    save_distances(s_id, neighbours, distance_type)
+
 
 @shared_task()
 def load_lstm_mfcc_representations(chunk_size, s_id):
     """
-    loads the lstm_mfcc representations of all songs that are in the database by chunks into a numpy array and then calls
-    a function to calculate the similarity of the song's specified by s_id lstm_mfcc representation to the chunk of songs
-    from the database that is currently being processed
-    :param chunk_size: the number of instances of Song whose lstm_mfcc representations are loaded into a numpy array
+    calculates the similarity of the song's specified by s_id lstm_mfcc representation to the lstm_mfcc
+    representations of all songs that are in the database using the nearest neighbour index
+    :param chunk_size: the number of songs whose lstm_mfcc similarities are calculated at once
     :param s_id: the id of the songs to which all the similarities are calculated to
     :return: None
     """
-    count = Song.objects.all().exclude(audio=False).count()
-    s = Song.objects.get(pk=s_id)
-    representations = numpy.empty([chunk_size, 5168])
-    i = 0
-    j = 0
-    for song in Song.objects.all().order_by('id').exclude(audio=False).only('id'):
-        if ((i % chunk_size) == 0) and (i != 0):
-            save_distances(s_id, s.lstm_mfcc_representation, representations, LSTM_MFCC_THRESHOLD, 'LSTM_MFCC', j * chunk_size,
-                           (j + 1) * chunk_size)
-            representations[i % chunk_size] = song.get_lstm_mfcc_representation()
-            j = j + 1
-        elif i >= (count - 1):
-            representations = representations[:i % chunk_size]
-            save_distances(s_id, s.lstm_mfcc_representation, representations, LSTM_MFCC_THRESHOLD, 'LSTM_MFCC', j * chunk_size,
-                           i)
-            break
-        else:
-            representations[i % chunk_size] = song.get_lstm_mfcc_representation()
-
-        i = i + 1
+    save_nearest_neighbours(s_id, 'LSTM_MFCC', LSTM_MFCC_THRESHOLD, chunk_size)
 
 
 @shared_task()
 def load_pca_mel_representations(chunk_size, s_id):
     """
-    loads the pca_mel representations of all songs that are in the database by chunks into a numpy array and then calls
-    a function to calculate the similarity of the song's specified by s_id pca_mel representation to the chunk of songs
-    from the database that is currently being processed
-    :param chunk_size: the number of instances of Song whose pca_mel representations are loaded into a numpy array
+    calculates the similarity of the song's specified by s_id pca_mel representation to the pca_mel
+    representations of all songs that are in the database using the nearest neighbour index
+    :param chunk_size: the number of songs whose pca_mel similarities are calculated at once
     :param s_id: the id of the songs to which all the similarities are calculated to
     :return: None
     """
-    count = Song.objects.all().exclude(audio=False).count()
-    s = Song.objects.get(pk=s_id)
-    representations = numpy.empty([chunk_size, 320])
-    i = 0
-    j = 0
-    for song in Song.objects.all().order_by('id').exclude(audio=False).only('pca_mel_representation'):
-        if ((i % chunk_size) == 0) and (i != 0):
-            save_distances(s_id, s.pca_mel_representation, representations, PCA_MEL_THRESHOLD, 'PCA_MEL', j * chunk_size,
-                           (j + 1) * chunk_size)
-            representations[i % chunk_size] = song.get_pca_mel_representation()
-            j = j + 1
-        elif i >= (count -1):
-            representations = representations[:i % chunk_size]
-            save_distances(s_id, s.pca_mel_representation, representations, PCA_MEL_THRESHOLD, 'PCA_MEL', j * chunk_size, i)
-            break
-        else:
-            representations[i % chunk_size] = song.get_pca_mel_representation()
-
-        i = i + 1
+    save_nearest_neighbours(s_id, 'PCA_MEL', PCA_MEL_THRESHOLD, chunk_size)
+
 
 @shared_task()
 def load_gru_mel_representations(chunk_size, s_id):
     """
-    loads the gru_mel representations of all songs that are in the database by chunks into a numpy array and then calls
-    a function to calculate the similarity of the song's specified by s_id gru_mel representation to the chunk of songs
-    from the database that is currently being processed
-    :param chunk_size: the number of instances of Song whose gru_mel representations are loaded into a numpy array
+    calculates the similarity of the song's specified by s_id gru_mel representation to the gru_mel
+    representations of all songs that are in the database using the nearest neighbour index
+    :param chunk_size: the number of songs whose gru_mel similarities are calculated at once
     :param s_id: the id of the songs to which all the similarities are calculated to
     :return: None
     """
-    count = Song.objects.all().exclude(audio=False).count()
-    s = Song.objects.get(pk=s_id)
-    representations = numpy.empty([chunk_size, 5712])
-    i = 0
-    j = 0
-    for song in Song.objects.all().order_by('id').exclude(audio=False).only('id'):
-        if ((i % chunk_size) == 0) and (i != 0):
-            save_distances(s_id, s.gru_mel_representation, representations, GRU_MEL_THRESHOLD, 'GRU_MEL', j * chunk_size,
-                           (j + 1) * chunk_size)
-            representations[i % chunk_size] = song.get_gru_mel_representation()
-            j = j + 1
-        elif i >= (count -1):
-            representations = representations[:i % chunk_size]
-            save_distances(s_id, s.gru_mel_representation, representations, GRU_MEL_THRESHOLD, 'GRU_MEL', j * chunk_size, i)
-            break
-        else:
-            representations[i % chunk_size] = song.get_gru_mel_representation()
-
-        i = i + 1
-
+    save_nearest_neighbours(s_id, 'GRU_MEL', GRU_MEL_THRESHOLD, chunk_size)
 
 
 @shared_task()
 def load_pca_tf_idf_representations(chunk_size, s_id):
     """
-        loads the pca_tf_idf representations of all songs that are in the database by chunks into a numpy array and then calls
-        a function to calculate the similarity of the song's specified by s_id pca_tf_idf representation to the chunk of songs
-        from the database that is currently being processed
-        :param chunk_size: the number of instances of Song whose pca_tf_idf representations are loaded into a numpy array
-        :param s_id: the id of the songs to which all the similarities are calculated to
-        :return: None
-        """
-    count = Song.objects.all().exclude(audio=False).count()
-    s = Song.objects.get(pk=s_id)
-    representations = numpy.empty([chunk_size, 4457])
-    i = 0
-    j = 0
-    for song in Song.objects.all().order_by('id').exclude(audio=False).only('id'):
-        if (i % chunk_size == 0) and (i != 0):
-            save_distances(s_id, s.pca_tf_idf_representation, representations, PCA_TF_IDF_THRESHOLD, 'PCA_TF-idf', j * chunk_size,
-                           (j + 1) * chunk_size)
-            representations[i % chunk_size] = song.get_pca_tf_idf_representation()
-            j = j + 1
-        elif i >= (count -1):
-            representations = representations[:i% chunk_size]
-            save_distances(s_id, s.pca_tf_idf_representation, representations, PCA_TF_IDF_THRESHOLD, 'PCA_TF-idf', j * chunk_size, i)
-            break
-        else:
-            representations[i % chunk_size] = song.get_pca_tf_idf_representation()
-        i = i + 1
-
+    calculates the similarity of the song's specified by s_id pca_tf_idf representation to the pca_tf_idf
+    representations of all songs that are in the database using the nearest neighbour index
+    :param chunk_size: the number of songs whose pca_tf_idf similarities are calculated at once
+    :param s_id: the id of the songs to which all the similarities are calculated to
+    :return: None
+    """
+    save_nearest_neighbours(s_id, 'PCA_TF-idf', PCA_TF_IDF_THRESHOLD, chunk_size)
 
 
 @shared_task()
 def load_w2v_representations(chunk_size, s_id):
     """
-    loads the w2v representations of all songs that are in the database by chunks into a numpy array and then calls
-    a function to calculate the similarity of the song's specified by s_id w2v representation to the chunk of songs
-    from the database that is currently being processed
-    :param chunk_size: the number of instances of Song whose w2v representations are loaded into a numpy array
+    calculates the similarity of the song's specified by s_id w2v representation to the w2v
+    representations of all songs that are in the database using the nearest neighbour index
+    :param chunk_size: the number of songs whose w2v similarities are calculated at once
     :param s_id: the id of the songs to which all the similarities are calculated to
     :return: None
     """
-    count = Song.objects.all().count()
-    s = Song.objects.get(pk=s_id)
-    representations = numpy.empty([chunk_size, 300])
-    i = 0
-    j = 0
-    for song in Song.objects.all().order_by('id').exclude(audio=False).only('w2v_representation'):
-        if ((i % chunk_size) == 0) and (i != 0):
-            save_distances(s_id, s.w2v_representation, representations, W2V_THRESHOLD, 'W2V', j * chunk_size,
-                           (j + 1) * chunk_size)
-            representations[i % chunk_size] = song.get_W2V_representation()
-            j = j + 1
-        elif i >= (count -1) :
-            representations = representations[:i% chunk_size]
-            save_distances(s_id, s.w2v_representation, representations, W2V_THRESHOLD, 'W2V', j * chunk_size, i)
-            break
-        else:
-            representations[i % chunk_size] = song.get_W2V_representation()
-
-        i = i + 1
+    save_nearest_neighbours(s_id, 'W2V', W2V_THRESHOLD, chunk_size)
 
 @shared_task()
-def save_distances(song_id, song_representation, representations, threshold, distance_type, start_index, end_index):
-    """
-    calculates and saves the similarities of songs specified by song_id to each of the songs whose representations are in the
-    representations parameter. These songs are songs from the web application whose audio property is set to True. The songs are given to this
-    method in chunks and the start_index and end_index help specify which song the representations in the representations matrix
-    belong to as it is necessary to acquire their ids to save the distance between the song specified by song_id and them.
-    It all the similarities of this song to the others are saved if it is not the similarity of the
-    song to itself and if the similarity is bigger then the threshold specified in settings.py
-    :param song_id: (int) the id of the song toward which all the similarities will be calculated
-    :param song_representation: (numpy array) a numpy array with the representation of the song specified by song_id. The representation
-    type corresponds to the distance_type.
-    :param representations: (numpy array) the representations of all the other songs whose similarity to the song specified
-    by song_id is being calculated
-    :param threshold: (float32) the threshold for the particular distance type
+def save_distances(song_id, neighbours, distance_type):
+    """
+    saves the similarities of the song specified by song_id to its nearest neighbours found by the nearest
+    neighbour index in both directions with bulk inserts. The similarity of the song to itself is skipped,
+    the neighbours are already only those whose similarity is bigger than the threshold specified in settings.py
+    :param song_id: (int) the id of the song toward which all the similarities were calculated
+    :param neighbours: (list) (song id, similarity) tuples of the most similar songs
     :param distance_type: (string) a string specifying the distance type of the method whose similarities are computed
-    :param start_index: (int) the start index of the list of songs in the database which is the first in the representation numpy matrix
-    :param end_index: (int) the last index of the slits of songs in the database which is the last in the representation numpy matrix
     :return: None
     """
-    song = Song.objects.get(pk=song_id)
-    print('distances', distance_type, 'to be calculated')
+    neighbours = [(song_2, distance) for song_2, distance in neighbours if song_2 != song_id]
     try:
-        distances = sklearn.metrics.pairwise.cosine_similarity(numpy.array(song_representation, dtype=float).reshape(1,-1), representations)
-        distances = distances.reshape([(end_index-start_index)])
-        print('distances calculated')
-        i = 0
-        print(start_index, end_index)
-        for song_2 in Song.objects.all().order_by('id').exclude(audio=False).values_list('id', flat=True)[(start_index):(end_index-1)]:
-            if song_id != song_2:
-                if distances[i] > threshold:
-                    s = Song.objects.get(pk=song_2)
-                    dist_1 = Distance(song_1=song, song_2=s, distance_Type=str(distance_type),
-                                      distance=distances[i].item())
-                    dist_2 = Distance(song_1=s, song_2=song, distance_Type=str(distance_type),
-                                      distance=distances[i].item())
-                    dist_1.save()
-                    dist_2.save()
-                    print('distance between' + str(song) + 'and' + str(s) + str(distances[i]) + 'saved')
-            i = i+1
+        saved = bulk_save_distances([song_id] * len(neighbours), [song_2 for song_2, _ in neighbours],
+                                    [distance for _, distance in neighbours], str(distance_type))
+        print(saved, 'distances', distance_type, 'saved')
     except Exception as e:
         print(e)
-
-    print('distances', distance_type, 'saved')